@@ -0,0 +1,207 @@
+import argparse
+import gzip
+import os
+import sqlite3
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from shutil import copyfileobj
+from typing import Callable, List, Optional, Union
+
+# Number of database pages copied per step. Locks are released between steps,
+# so the app can keep reading and writing while a backup is in progress.
+BACKUP_PAGES = 256
+
+# Default retention policy.
+KEEP_LAST = 10
+KEEP_DAILY = 7
+KEEP_MONTHLY = 12
+
+
+def get_backup_path(
+    database_file_path: Union[str, Path], db_hash: str, compress: bool = False
+) -> Path:
+    """
+    Format: "{filename}.backup_{hash}", with a ".gz" suffix if compressed.
+
+    Example: "db.sql.backup_d7f030ec"
+    """
+    database_file_path = Path(database_file_path)
+    backup_fn = f"{database_file_path.name}.backup_{db_hash}"
+    if compress:
+        backup_fn += ".gz"
+    return Path(database_file_path.parent, backup_fn)
+
+
+def list_backups(database_file_path: Union[str, Path]) -> List[Path]:
+    """
+    All backups of a database, newest first.
+    """
+    database_file_path = Path(database_file_path)
+    backup_list = [
+        path
+        for path in database_file_path.parent.glob(
+            f"{database_file_path.name}.backup_*"
+        )
+        if not path.name.endswith(".tmp")
+    ]
+    return sorted(backup_list, key=lambda path: path.stat().st_mtime, reverse=True)
+
+
+def create_backup(
+    connection: sqlite3.Connection,
+    database_file_path: Union[str, Path],
+    db_hash: str,
+    compress: bool = False,
+    pages: int = BACKUP_PAGES,
+    progress: Optional[Callable[[int, int, int], None]] = None,
+) -> Optional[Path]:
+    """
+    If a backup with the same hash does not already exist, create one using
+    the SQLite online backup API. Returns the path of the new backup, or None
+    if one already existed.
+
+    The backup is written to a temporary file first and renamed once
+    complete, so an interrupted backup never leaves a partial file behind.
+    """
+    for existing_path in [
+        get_backup_path(database_file_path, db_hash, compress=False),
+        get_backup_path(database_file_path, db_hash, compress=True),
+    ]:
+        if existing_path.exists():
+            return None
+
+    backup_path = get_backup_path(database_file_path, db_hash, compress=compress)
+    fd, tmp_name = tempfile.mkstemp(
+        prefix=f"{backup_path.name}.", suffix=".tmp", dir=backup_path.parent
+    )
+    os.close(fd)
+    tmp_path = Path(tmp_name)
+    try:
+        target = sqlite3.connect(tmp_path)
+        try:
+            connection.backup(target, pages=pages, progress=progress)
+        finally:
+            target.close()
+        if compress:
+            _compress(tmp_path)
+        os.replace(tmp_path, backup_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return backup_path
+
+
+def restore_backup(
+    backup_path: Union[str, Path],
+    database_file_path: Union[str, Path],
+    pages: int = BACKUP_PAGES,
+    progress: Optional[Callable[[int, int, int], None]] = None,
+) -> None:
+    """
+    Overwrite the database with the contents of a backup. This also uses the
+    online backup API, so it is safe while other connections are open.
+    """
+    backup_path = Path(backup_path)
+    tmp_path = None
+    if backup_path.suffix == ".gz":
+        fd, tmp_name = tempfile.mkstemp(suffix=".tmp", dir=backup_path.parent)
+        os.close(fd)
+        tmp_path = Path(tmp_name)
+        with gzip.open(backup_path, "rb") as f_in, open(tmp_path, "wb") as f_out:
+            copyfileobj(f_in, f_out)
+        source_path = tmp_path
+    else:
+        source_path = backup_path
+    try:
+        source = sqlite3.connect(source_path)
+        target = sqlite3.connect(database_file_path)
+        try:
+            source.backup(target, pages=pages, progress=progress)
+        finally:
+            source.close()
+            target.close()
+    finally:
+        if tmp_path is not None and tmp_path.exists():
+            tmp_path.unlink()
+
+
+def prune_backups(
+    database_file_path: Union[str, Path],
+    keep_last: int = KEEP_LAST,
+    keep_daily: int = KEEP_DAILY,
+    keep_monthly: int = KEEP_MONTHLY,
+) -> List[Path]:
+    """
+    Delete backups outside of the retention policy. Kept are the `keep_last`
+    newest backups, plus the newest backup of each of the last `keep_daily`
+    days and of each of the last `keep_monthly` months that have a backup.
+    Returns the deleted paths.
+    """
+    backup_list = list_backups(database_file_path)
+    keep = set(backup_list[:keep_last])
+    days = {}
+    months = {}
+    for path in backup_list:
+        date = datetime.fromtimestamp(path.stat().st_mtime)
+        days.setdefault(date.strftime("%Y-%m-%d"), path)
+        months.setdefault(date.strftime("%Y-%m"), path)
+    keep.update(list(days.values())[:keep_daily])
+    keep.update(list(months.values())[:keep_monthly])
+
+    removed = []
+    for path in backup_list:
+        if path not in keep:
+            # Another worker may be pruning the same backups.
+            path.unlink(missing_ok=True)
+            removed.append(path)
+    return removed
+
+
+def _compress(path: Path) -> None:
+    """
+    Gzip a file in place.
+    """
+    compressed_path = path.with_name(path.name + ".gz")
+    with open(path, "rb") as f_in, gzip.open(compressed_path, "wb") as f_out:
+        copyfileobj(f_in, f_out)
+    os.replace(compressed_path, path)
+
+
+def main():
+    from database import Database
+
+    parser = argparse.ArgumentParser(description="Manage database backups.")
+    parser.add_argument("database", help="Path to the database file.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List backups, newest first.")
+    create_parser = subparsers.add_parser("create", help="Back up the database.")
+    create_parser.add_argument("--compress", action="store_true")
+    subparsers.add_parser("prune", help="Apply the retention policy.")
+    restore_parser = subparsers.add_parser(
+        "restore", help="Restore the database from a backup."
+    )
+    restore_parser.add_argument("backup", help="Path to the backup file.")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for path in list_backups(args.database):
+            date = datetime.fromtimestamp(path.stat().st_mtime)
+            print(f"{date:%Y-%m-%d %H:%M:%S}  {path}")
+    elif args.command == "create":
+        with Database(args.database) as db:
+            backup_path = db.backup(compress=args.compress)
+        print(backup_path or "A backup of this database state already exists.")
+    elif args.command == "prune":
+        for path in prune_backups(args.database):
+            print(f"Removed {path}")
+    elif args.command == "restore":
+        # Back up the current state first, so the restore can be undone.
+        with Database(args.database) as db:
+            db.backup()
+        restore_backup(args.backup, args.database)
+        print(f"Restored {args.database} from {args.backup}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,24 @@
+import json
+import re
 import sqlite3
+import threading
 import warnings
+from functools import lru_cache
 from pathlib import Path
-from shutil import copy
-from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+from typing import (
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 from zlib import crc32
 
+from backup import create_backup, prune_backups
+
 
 class Transaction(NamedTuple):
     date: str
@@ -13,30 +27,387 @@ class Transaction(NamedTuple):
     category: Optional[str] = "__UNKNOWN__"
 
 
+class ImportResult(NamedTuple):
+    inserted: int
+    duplicates: int
+    conflicts: int
+
+
 class Database:
+    """
+    Context manager that checks out a connection from the pool of the database
+    file and returns it to the pool on exit. Uncommitted changes are rolled
+    back on exit.
+    """
+
     def __init__(self, database_file_path):
         self.database_file_path = database_file_path
         self.connection = None
+        self._pool = None
+        self._db = None
 
     def __enter__(self):
-        db = _Database(self.database_file_path)
-        self.connection = db.connection
-        return db
+        self._pool = _get_pool(self.database_file_path)
+        self._db = self._pool.acquire()
+        self.connection = self._db.connection
+        return self._db
 
     def __exit__(self, exception_type, exception_value, exception_traceback):
-        if self.connection is not None:
-            self.connection.close()
+        if self._db is not None:
+            self._pool.release(self._db)
+            self._db = None
         if exception_type is not None:
             return False  # Re-raise exception.
 
 
+# Settings applied to every connection.
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-32768",  # 32 MiB
+    "PRAGMA mmap_size=268435456",  # 256 MiB
+    "PRAGMA temp_store=MEMORY",
+]
+
+# Maximum number of idle connections kept open per database file.
+MAX_IDLE_CONNECTIONS = 8
+
+# Category of a name that already exists when a transaction of that name is
+# added: its own, unless it has none yet.
+_NAMES_CATEGORY_ON_CONFLICT = (
+    "CASE WHEN names.category = '__UNKNOWN__' "
+    "THEN excluded.category ELSE names.category END"
+)
+
+# Schema migrations. Entry i upgrades the schema from version i to i + 1. The
+# schema version of a database file is stored in its user_version pragma.
+MIGRATIONS: List[List[str]] = [
+    # Version 1: a name to category index, kept in sync by triggers.
+    [
+        "CREATE TABLE IF NOT EXISTS names("
+        "name TEXT PRIMARY KEY,"
+        "category TEXT,"
+        "count INTEGER NOT NULL,"
+        "total FLOAT NOT NULL"
+        ")",
+        "CREATE INDEX IF NOT EXISTS names_category "
+        "ON names(category, count, total)",
+        "CREATE INDEX IF NOT EXISTS bank_records_name ON bank_records(name)",
+        "DELETE FROM names",
+        "INSERT INTO names "
+        "SELECT name, category, COUNT(*), SUM(amount) "
+        "FROM bank_records "
+        "GROUP BY name",
+        "CREATE TRIGGER IF NOT EXISTS names_insert "
+        "AFTER INSERT ON bank_records "
+        "BEGIN "
+        "INSERT INTO names(name, category, count, total) "
+        "VALUES (NEW.name, NEW.category, 1, NEW.amount) "
+        "ON CONFLICT(name) DO UPDATE "
+        "SET count = count + 1, total = total + excluded.total; "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS names_delete "
+        "AFTER DELETE ON bank_records "
+        "BEGIN "
+        "UPDATE names "
+        "SET count = count - 1, total = total - OLD.amount "
+        "WHERE name = OLD.name; "
+        "DELETE FROM names WHERE name = OLD.name AND count <= 0; "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS names_update_category "
+        "AFTER UPDATE OF category ON bank_records "
+        "WHEN NEW.name IS OLD.name AND NEW.category IS NOT OLD.category "
+        "BEGIN "
+        "UPDATE names SET category = NEW.category WHERE name = NEW.name; "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS names_update "
+        "AFTER UPDATE OF name, amount ON bank_records "
+        "BEGIN "
+        "UPDATE names "
+        "SET count = count - 1, total = total - OLD.amount "
+        "WHERE name = OLD.name; "
+        "DELETE FROM names WHERE name = OLD.name AND count <= 0; "
+        "INSERT INTO names(name, category, count, total) "
+        "VALUES (NEW.name, NEW.category, 1, NEW.amount) "
+        "ON CONFLICT(name) DO UPDATE "
+        "SET count = count + 1, total = total + excluded.total; "
+        "END",
+    ],
+    # Version 2: an order-independent fingerprint of bank_records, kept up to
+    # date by triggers. It is the sum of the row hashes of all transactions.
+    [
+        "CREATE TABLE IF NOT EXISTS metadata("
+        "key TEXT PRIMARY KEY,"
+        "value INTEGER NOT NULL"
+        ")",
+        "INSERT OR REPLACE INTO metadata "
+        "SELECT 'fingerprint', IFNULL(SUM(row_hash(date, name, amount, category)), 0) "
+        "FROM bank_records",
+        "CREATE TRIGGER IF NOT EXISTS fingerprint_insert "
+        "AFTER INSERT ON bank_records "
+        "BEGIN "
+        "UPDATE metadata "
+        "SET value = value + row_hash(NEW.date, NEW.name, NEW.amount, NEW.category) "
+        "WHERE key = 'fingerprint'; "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS fingerprint_delete "
+        "AFTER DELETE ON bank_records "
+        "BEGIN "
+        "UPDATE metadata "
+        "SET value = value - row_hash(OLD.date, OLD.name, OLD.amount, OLD.category) "
+        "WHERE key = 'fingerprint'; "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS fingerprint_update "
+        "AFTER UPDATE ON bank_records "
+        "BEGIN "
+        "UPDATE metadata "
+        "SET value = value "
+        "- row_hash(OLD.date, OLD.name, OLD.amount, OLD.category) "
+        "+ row_hash(NEW.date, NEW.name, NEW.amount, NEW.category) "
+        "WHERE key = 'fingerprint'; "
+        "END",
+    ],
+    # Version 3: indexes for the dashboard filters on category and date. The
+    # index on name was added in version 1.
+    [
+        "CREATE INDEX IF NOT EXISTS bank_records_category_date "
+        "ON bank_records(category, date)",
+        "CREATE INDEX IF NOT EXISTS bank_records_date ON bank_records(date)",
+        "ANALYZE",
+    ],
+    # Version 4: the sum and count of amounts per month and category, kept up
+    # to date by triggers. Ignored transactions, with a NULL category, are
+    # left out.
+    [
+        "CREATE TABLE IF NOT EXISTS monthly_totals("
+        "month TEXT NOT NULL,"
+        "category TEXT NOT NULL,"
+        "total FLOAT NOT NULL,"
+        "count INTEGER NOT NULL,"
+        "PRIMARY KEY(month, category)"
+        ")",
+        "DELETE FROM monthly_totals",
+        "INSERT INTO monthly_totals "
+        "SELECT substr(date, 1, 7), category, SUM(amount), COUNT(*) "
+        "FROM bank_records "
+        "WHERE category IS NOT NULL "
+        "GROUP BY 1, 2",
+        "CREATE TRIGGER IF NOT EXISTS monthly_totals_insert "
+        "AFTER INSERT ON bank_records "
+        "WHEN NEW.category IS NOT NULL "
+        "BEGIN "
+        "INSERT INTO monthly_totals(month, category, total, count) "
+        "VALUES (substr(NEW.date, 1, 7), NEW.category, NEW.amount, 1) "
+        "ON CONFLICT(month, category) DO UPDATE "
+        "SET total = total + excluded.total, count = count + 1; "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS monthly_totals_delete "
+        "AFTER DELETE ON bank_records "
+        "WHEN OLD.category IS NOT NULL "
+        "BEGIN "
+        "UPDATE monthly_totals "
+        "SET total = total - OLD.amount, count = count - 1 "
+        "WHERE month = substr(OLD.date, 1, 7) AND category = OLD.category; "
+        "DELETE FROM monthly_totals "
+        "WHERE month = substr(OLD.date, 1, 7) AND category = OLD.category "
+        "AND count <= 0; "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS monthly_totals_update_old "
+        "AFTER UPDATE OF date, amount, category ON bank_records "
+        "WHEN OLD.category IS NOT NULL "
+        "BEGIN "
+        "UPDATE monthly_totals "
+        "SET total = total - OLD.amount, count = count - 1 "
+        "WHERE month = substr(OLD.date, 1, 7) AND category = OLD.category; "
+        "DELETE FROM monthly_totals "
+        "WHERE month = substr(OLD.date, 1, 7) AND category = OLD.category "
+        "AND count <= 0; "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS monthly_totals_update_new "
+        "AFTER UPDATE OF date, amount, category ON bank_records "
+        "WHEN NEW.category IS NOT NULL "
+        "BEGIN "
+        "INSERT INTO monthly_totals(month, category, total, count) "
+        "VALUES (substr(NEW.date, 1, 7), NEW.category, NEW.amount, 1) "
+        "ON CONFLICT(month, category) DO UPDATE "
+        "SET total = total + excluded.total, count = count + 1; "
+        "END",
+    ],
+    # Version 5: a generation counter, incremented on every change to
+    # bank_records. Views compare it to know whether their data changed.
+    [
+        "INSERT OR IGNORE INTO metadata VALUES ('generation', 0)",
+        "CREATE TRIGGER IF NOT EXISTS generation_insert "
+        "AFTER INSERT ON bank_records "
+        "BEGIN "
+        "UPDATE metadata SET value = value + 1 WHERE key = 'generation'; "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS generation_delete "
+        "AFTER DELETE ON bank_records "
+        "BEGIN "
+        "UPDATE metadata SET value = value + 1 WHERE key = 'generation'; "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS generation_update "
+        "AFTER UPDATE ON bank_records "
+        "BEGIN "
+        "UPDATE metadata SET value = value + 1 WHERE key = 'generation'; "
+        "END",
+    ],
+    # Version 6: background jobs, run by jobs.JobRunner.
+    [
+        "CREATE TABLE IF NOT EXISTS jobs("
+        "id INTEGER PRIMARY KEY,"
+        "kind TEXT,"
+        "status TEXT,"
+        "message TEXT,"
+        "result TEXT,"
+        "created TEXT,"
+        "updated TEXT"
+        ")",
+    ],
+    # Version 7: parameters of the sessions of the app, shared by its workers.
+    [
+        "CREATE TABLE IF NOT EXISTS sessions("
+        "id TEXT PRIMARY KEY,"
+        "revision INTEGER,"
+        "params TEXT,"
+        "updated TEXT"
+        ")",
+    ],
+    # Version 8: the fingerprint is computed when it is read, if the data
+    # changed since it was last computed. Triggers calling row_hash made the
+    # database unwritable by connections without the function, such as the
+    # sqlite3 shell.
+    [
+        "DROP TRIGGER IF EXISTS fingerprint_insert",
+        "DROP TRIGGER IF EXISTS fingerprint_delete",
+        "DROP TRIGGER IF EXISTS fingerprint_update",
+        "INSERT OR REPLACE INTO metadata VALUES ('fingerprint_generation', -1)",
+    ],
+    # Version 9: the process running each job, so that a worker starting only
+    # fails the jobs of processes that are gone.
+    [
+        "ALTER TABLE jobs ADD COLUMN owner INTEGER",
+    ],
+    # Version 10: changes to bank_records since the fingerprint was computed,
+    # logged by plain SQL triggers. Reading the fingerprint adds the hashes of
+    # the changes to it, rather than summing the hashes of all rows again.
+    [
+        "CREATE TABLE IF NOT EXISTS fingerprint_changes("
+        "sign INTEGER NOT NULL,"
+        "date TEXT,"
+        "name TEXT,"
+        "amount FLOAT,"
+        "category TEXT"
+        ")",
+        "CREATE TRIGGER IF NOT EXISTS fingerprint_changes_insert "
+        "AFTER INSERT ON bank_records "
+        "BEGIN "
+        "INSERT INTO fingerprint_changes "
+        "VALUES (1, NEW.date, NEW.name, NEW.amount, NEW.category); "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS fingerprint_changes_delete "
+        "AFTER DELETE ON bank_records "
+        "BEGIN "
+        "INSERT INTO fingerprint_changes "
+        "VALUES (-1, OLD.date, OLD.name, OLD.amount, OLD.category); "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS fingerprint_changes_update "
+        "AFTER UPDATE ON bank_records "
+        "BEGIN "
+        "INSERT INTO fingerprint_changes "
+        "VALUES (-1, OLD.date, OLD.name, OLD.amount, OLD.category), "
+        "(1, NEW.date, NEW.name, NEW.amount, NEW.category); "
+        "END",
+        # Changes before this version were not logged.
+        "UPDATE metadata SET value = -1 "
+        "WHERE key = 'fingerprint_generation' "
+        "AND value IS NOT (SELECT value FROM metadata WHERE key = 'generation')",
+    ],
+    # Version 11: a name without a category takes the category of the first
+    # categorized transaction added with it. The triggers of version 1 only
+    # updated the count and total of a name that already existed.
+    [
+        "DROP TRIGGER IF EXISTS names_insert",
+        "DROP TRIGGER IF EXISTS names_update",
+        "CREATE TRIGGER names_insert "
+        "AFTER INSERT ON bank_records "
+        "BEGIN "
+        "INSERT INTO names(name, category, count, total) "
+        "VALUES (NEW.name, NEW.category, 1, NEW.amount) "
+        "ON CONFLICT(name) DO UPDATE "
+        "SET count = count + 1, total = total + excluded.total, "
+        f"category = {_NAMES_CATEGORY_ON_CONFLICT}; "
+        "END",
+        "CREATE TRIGGER names_update "
+        "AFTER UPDATE OF name, amount ON bank_records "
+        "BEGIN "
+        "UPDATE names "
+        "SET count = count - 1, total = total - OLD.amount "
+        "WHERE name = OLD.name; "
+        "DELETE FROM names WHERE name = OLD.name AND count <= 0; "
+        "INSERT INTO names(name, category, count, total) "
+        "VALUES (NEW.name, NEW.category, 1, NEW.amount) "
+        "ON CONFLICT(name) DO UPDATE "
+        "SET count = count + 1, total = total + excluded.total, "
+        f"category = {_NAMES_CATEGORY_ON_CONFLICT}; "
+        "END",
+        # Names left without a category by the old triggers.
+        "UPDATE names "
+        "SET category = ("
+        "SELECT category FROM bank_records "
+        "WHERE bank_records.name = names.name "
+        "AND bank_records.category IS NOT '__UNKNOWN__' "
+        "ORDER BY rowid LIMIT 1"
+        ") "
+        "WHERE category = '__UNKNOWN__' "
+        "AND EXISTS ("
+        "SELECT 1 FROM bank_records "
+        "WHERE bank_records.name = names.name "
+        "AND bank_records.category IS NOT '__UNKNOWN__'"
+        ")",
+    ],
+]
+
+
+@lru_cache(maxsize=64)
+def _compile_regexp(pattern: str) -> re.Pattern:
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def regexp(pattern: str, string: str) -> bool:
+    """
+    Implements the REGEXP operator, case-insensitive. Each pattern is only
+    compiled once.
+    """
+    return _compile_regexp(pattern).search(string) is not None
+
+
+def row_hash(*values) -> int:
+    """
+    Hash of one transaction row, summed over the rows for the fingerprint.
+    Registered as an SQL function on every connection.
+    """
+    return crc32("".join([str(v) for v in values]).encode("utf-8"))
+
+
 class _Database:
-    def __init__(self, database_file_path):
+    def __init__(self, database_file_path, check_schema: bool = True):
         self.database_file_path = Path(database_file_path)
         self.database_file_path.parent.mkdir(parents=True, exist_ok=True)
-        self.connection = sqlite3.connect(database_file_path)
+        # Pooled connections are handed from thread to thread, but only ever
+        # used by one thread at a time.
+        self.connection = sqlite3.connect(
+            database_file_path, check_same_thread=False
+        )
+        self.connection.create_function("row_hash", 4, row_hash, deterministic=True)
+        self.connection.create_function("REGEXP", 2, regexp, deterministic=True)
         self.cursor = self.connection.cursor()
+        for pragma in PRAGMAS:
+            self.cursor.execute(pragma)
         self.table_name = "bank_records"
+        if not check_schema:
+            return
 
         # Create the table if it does not yet exist.
         check = self.cursor.execute(
@@ -49,7 +420,7 @@ class _Database:
         assert db_exists in [0, 1]
         if not db_exists:
             self.cursor.execute(
-                f"CREATE TABLE {self.table_name}("
+                f"CREATE TABLE IF NOT EXISTS {self.table_name}("
                 "date TEXT,"
                 "name TEXT,"
                 "amount FLOAT,"
@@ -57,129 +428,355 @@ class _Database:
                 "UNIQUE(date, name, amount)"
                 ")"
             )
+        self.migrate()
+
+    def migrate(self) -> None:
+        """
+        Upgrade the schema to the latest version, one migration at a time. Each
+        migration is applied in its own transaction.
+
+        Several processes may open the database at once, e.g. the workers of
+        the app. Each migration takes the write lock first, then reads the
+        version again, so that only one process applies it.
+        """
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        while version < len(MIGRATIONS):
+            try:
+                self.cursor.execute("BEGIN IMMEDIATE")
+                version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+                if version < len(MIGRATIONS):
+                    for statement in MIGRATIONS[version]:
+                        self.cursor.execute(statement)
+                    version += 1
+                    self.cursor.execute(f"PRAGMA user_version={version}")
+                self.cursor.execute("COMMIT")
+            except Exception:
+                if self.connection.in_transaction:
+                    self.cursor.execute("ROLLBACK")
+                print(f"Error when migrating database to version {version + 1}")
+                raise
+
+    def query_plan(self, sql: str, params: Sequence = ()) -> List[str]:
+        """
+        The steps of the EXPLAIN QUERY PLAN of a query, such as
+        "SEARCH bank_records USING INDEX bank_records_name (name=?)".
+        """
+        result = self.cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return [row[3] for row in result.fetchall()]
 
     def add_transactions(
         self,
         transaction_list: List[Transaction],
         raise_on_duplicate=False,
-    ) -> None:
+        commit=True,
+        warn=True,
+    ) -> ImportResult:
+        """
+        Bulk insert transactions, matching each to the category already known
+        for its name. Categories are resolved with set-based queries against the
+        names table instead of one query per transaction.
+
+        Transactions that already exist in the database are skipped and counted
+        as duplicates. Transactions passed with a category that differs from
+        the one already associated with their name are skipped and counted as
+        conflicts. A name without a category takes the category of the first
+        categorized transaction added with it.
+
+        With `commit=False`, the caller is responsible for committing, which
+        allows several batches to be added in one transaction.
+        """
         for tx in transaction_list:
             assert isinstance(tx, Transaction)
 
-        # Match each transaction to a category, if known.
-        transactions_with_categories = self.match_transactions_to_categories(
-            transaction_list
+        # Load the batch into a temporary table.
+        self.cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS import_batch("
+            "date TEXT,"
+            "name TEXT,"
+            "amount FLOAT,"
+            "category TEXT"
+            ")"
+        )
+        if not self.connection.in_transaction:
+            # Take the write lock up front. A deferred transaction that reads
+            # first cannot wait for the lock once another writer committed.
+            self.cursor.execute("BEGIN IMMEDIATE")
+        self.cursor.execute("DELETE FROM temp.import_batch")
+        self.cursor.executemany(
+            "INSERT INTO temp.import_batch VALUES (?, ?, ?, ?)", transaction_list
         )
 
-        # After matching each transaction to a category, add them to db.
-        for tx in transactions_with_categories:
-            try:
-                self.cursor.execute(
-                    f"INSERT INTO {self.table_name} VALUES (?, ?, ?, ?)", tx
-                )
-            except sqlite3.IntegrityError:
-                # UNIQUE constraint failed. Entry already exists. Don't add.
-                msg = (
-                    f"Entry date, name, and amount already exists: {tx}. "
-                    "Will not add this transaction to the database."
-                )
-                if raise_on_duplicate:
-                    print(msg)
-                    raise
-                else:
-                    warnings.warn(msg)
-            except Exception:
-                print(f"Error when adding transaction: {tx}")
-                raise
-        self.connection.commit()
+        # Count and drop transactions whose category conflicts with the one
+        # already associated with their name.
+        conflict = (
+            "SELECT 1 FROM names "
+            "WHERE names.name = import_batch.name "
+            "AND import_batch.category IS NOT '__UNKNOWN__' "
+            "AND names.category IS NOT '__UNKNOWN__' "
+            "AND import_batch.category IS NOT names.category"
+        )
+        n_conflicts = self.cursor.execute(
+            f"DELETE FROM temp.import_batch WHERE EXISTS ({conflict})"
+        ).rowcount
 
-    def match_transactions_to_categories(
-        self, transaction_list: List[Transaction]
-    ) -> List[Transaction]:
-        transactions_with_categories = []
-        for tx in transaction_list:
-            category = self.get_category_by_name(tx.name)
-            if tx.category != "__UNKNOWN__" and category != "__UNKNOWN__":
-                if tx.category != category:
-                    raise ValueError(
-                        f'Transaction with name "{tx.name}" passed to the '
-                        f'database with category "{tx.category}" but this name '
-                        f'is already associated with category "{category}".'
-                    )
-            if category == "__UNKNOWN__":
-                category = tx.category
-            transaction = Transaction(
-                date=tx.date,
-                name=tx.name,
-                amount=tx.amount,
-                category=category,
+        # Use the known category of each name, if any.
+        self.cursor.execute(
+            "UPDATE temp.import_batch "
+            "SET category = ("
+            "SELECT category FROM names WHERE names.name = import_batch.name"
+            ") "
+            "WHERE EXISTS ("
+            "SELECT 1 FROM names "
+            "WHERE names.name = import_batch.name "
+            "AND names.category IS NOT '__UNKNOWN__'"
+            ")"
+        )
+
+        # Insert, skipping duplicates.
+        n_inserted = self.cursor.execute(
+            f"INSERT OR IGNORE INTO {self.table_name} "
+            "SELECT * FROM temp.import_batch"
+        ).rowcount
+        self.cursor.execute("DELETE FROM temp.import_batch")
+        result = ImportResult(
+            inserted=n_inserted,
+            duplicates=len(transaction_list) - n_inserted - n_conflicts,
+            conflicts=n_conflicts,
+        )
+
+        if result.duplicates and raise_on_duplicate:
+            self.connection.rollback()
+            raise sqlite3.IntegrityError(
+                f"{result.duplicates} transactions already exist in the database."
             )
-            transactions_with_categories.append(transaction)
-        return transactions_with_categories
-
-    def get_category_by_name(self, name: str) -> Optional[str]:
-        category_list = self.cursor.execute(
-            f"SELECT DISTINCT category FROM {self.table_name} WHERE name=?",
-            (name,),
-        ).fetchall()
-        if len(category_list) == 0:
-            return "__UNKNOWN__"
-        assert len(set(category_list)) == 1
-        return category_list[0][0]
+        if warn and (result.duplicates or result.conflicts):
+            warnings.warn(
+                f"{result.duplicates} duplicate transactions and "
+                f"{result.conflicts} transactions with conflicting categories "
+                "were not added to the database."
+            )
+        if commit:
+            self.connection.commit()
+        return result
 
     def get_uncategorized_names(self) -> Dict[str, int]:
         """
         Sorts the distinct names according to how often they appear.
         """
         result = self.cursor.execute(
-            "SELECT name, COUNT(*) "
-            f"FROM {self.table_name} "
+            "SELECT name, count "
+            "FROM names "
             "WHERE category=? "
-            "GROUP BY name "
-            "ORDER BY COUNT(*) ASC, SUM(amount) ASC, name DESC",
+            "ORDER BY count ASC, total ASC, name DESC",
             ("__UNKNOWN__",),
         )
         return dict(result.fetchall())
 
-    def set_name_category(self, name: str, category: Optional[str]) -> None:
-        if category is None:
-            set_to = "NULL"
-        else:
-            set_to = f"'{category}'"
-        self.cursor.execute(
-            f"UPDATE {self.table_name} SET category={set_to} WHERE name=?",
-            (name,),
+    def get_categorized_names(self) -> List[Tuple[str, str, float]]:
+        """
+        The name, category and mean amount of every name that has a category.
+        """
+        result = self.cursor.execute(
+            "SELECT name, category, total / count "
+            "FROM names "
+            "WHERE category IS NOT NULL AND category!=?",
+            ("__UNKNOWN__",),
         )
-        self.connection.commit()
+        return result.fetchall()
+
+    def get_mean_amounts(
+        self, name_list: Optional[List[str]] = None
+    ) -> Dict[str, float]:
+        """
+        The mean amount of each name in the list, or of all names.
+        """
+        if name_list is None:
+            result = self.cursor.execute("SELECT name, total / count FROM names")
+        else:
+            result = self.cursor.execute(
+                "SELECT name, total / count "
+                "FROM names "
+                "WHERE name IN (SELECT value FROM json_each(?))",
+                (json.dumps(name_list),),
+            )
+        return dict(result.fetchall())
+
+    def set_categories(
+        self, category_by_name: Dict[str, Optional[str]], commit: bool = True
+    ) -> None:
+        """
+        Set the category of every transaction of each name, in one transaction
+        with a single commit. A None category is stored as NULL. If any update
+        fails, none are applied.
+
+        With `commit=False`, the caller is responsible for committing.
+        """
+        if len(category_by_name) == 0:
+            return
+        if not self.connection.in_transaction:
+            self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            self.cursor.executemany(
+                f"UPDATE {self.table_name} SET category=? "
+                "WHERE name=? AND category IS NOT ?",
+                [
+                    (category, name, category)
+                    for name, category in category_by_name.items()
+                ],
+            )
+        except Exception:
+            self.connection.rollback()
+            raise
+        if commit:
+            self.connection.commit()
 
     def get_all_categories(self) -> List[Union[None, str]]:
-        result = self.cursor.execute(f"SELECT DISTINCT category FROM {self.table_name}")
+        result = self.cursor.execute("SELECT DISTINCT category FROM names")
         retval = [val[0] for val in result.fetchall() if val[0] is not None]
         return retval
 
-    def hash(self):
-        result = self.cursor.execute(f"SELECT * FROM {self.table_name}").fetchall()
-        transaction_string_list = []
-        for tx in result:
-            transaction_string_list.append("".join([str(v) for v in tx]))
-        db_string = "\n".join(sorted(transaction_string_list))
-        db_hash_dec = crc32(db_string.encode("utf-8"))
-        db_hash = hex(db_hash_dec)[2:]  # Skip initial '0x'; doesn't change
-        return db_hash
+    def hash(self) -> str:
+        """
+        Fingerprint of the transactions in the database. It only depends on
+        the data, not on the order in which it was written.
 
-    def backup(self):
+        It is stored with the generation it was computed for. When the data
+        changed since, the hashes of the rows logged in fingerprint_changes
+        are added to it, and the log is cleared: the cost is that of the
+        changes. Only if the fingerprint was never computed, e.g. after the
+        upgrade to schema version 10, are the hashes of all rows summed, which
+        is O(n). The write lock is only taken when the data changed.
         """
-        If a backup with the same hash does not already exist, create one.
+        query = (
+            "SELECT "
+            "(SELECT value FROM metadata WHERE key = 'fingerprint'), "
+            "(SELECT value FROM metadata WHERE key = 'fingerprint_generation'), "
+            "(SELECT value FROM metadata WHERE key = 'generation')"
+        )
+        value, fingerprint_generation, generation = self.cursor.execute(
+            query
+        ).fetchone()
+        if fingerprint_generation != generation:
+            if not self.connection.in_transaction:
+                self.cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # Another connection may have updated it in the meantime.
+                value, fingerprint_generation, generation = self.cursor.execute(
+                    query
+                ).fetchone()
+                if fingerprint_generation == -1:
+                    value = self.cursor.execute(
+                        "SELECT IFNULL(SUM(row_hash(date, name, amount, category)), 0) "
+                        f"FROM {self.table_name}"
+                    ).fetchone()[0]
+                elif fingerprint_generation != generation:
+                    value += self.cursor.execute(
+                        "SELECT IFNULL("
+                        "SUM(sign * row_hash(date, name, amount, category)), 0"
+                        ") FROM fingerprint_changes"
+                    ).fetchone()[0]
+                self.cursor.execute("DELETE FROM fingerprint_changes")
+                self.cursor.executemany(
+                    "INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                    [("fingerprint", value), ("fingerprint_generation", generation)],
+                )
+            except Exception:
+                self.connection.rollback()
+                raise
+            self.connection.commit()
+        return format(value % (1 << 32), "x")
+
+    def generation(self) -> int:
+        """
+        Counter incremented on every change to the transactions.
+        """
+        return self.cursor.execute(
+            "SELECT value FROM metadata WHERE key = 'generation'"
+        ).fetchone()[0]
+
+    def backup(
+        self,
+        compress: bool = False,
+        prune: bool = True,
+        progress: Optional[Callable[[int, int, int], None]] = None,
+    ) -> Optional[Path]:
+        """
+        If a backup with the same hash does not already exist, create one, then
+        delete old backups according to the retention policy.
 
-        Format: "{filename}.backup_{hash}"
+        Format: "{filename}.backup_{hash}", with a ".gz" suffix if compressed.
 
         Example: "db.sql.backup_d7f030ec"
         """
-        hash_db = self.hash()
-        backup_fn = f"{self.database_file_path.name}.backup_{hash_db}"
-        backup_path = Path(self.database_file_path.parent, backup_fn)
-        if not backup_path.exists():
-            copy(
-                self.database_file_path,
-                backup_path,
+        backup_path = create_backup(
+            self.connection,
+            self.database_file_path,
+            self.hash(),
+            compress=compress,
+            progress=progress,
+        )
+        if prune:
+            prune_backups(self.database_file_path)
+        return backup_path
+
+
+class _ConnectionPool:
+    """
+    Idle connections to one database file. The schema is checked and migrated
+    by the first connection only.
+    """
+
+    def __init__(self, database_file_path):
+        self.database_file_path = database_file_path
+        self.schema_checked = False
+        self.idle: List[_Database] = []
+        self.lock = threading.Lock()
+        self.connect_lock = threading.Lock()
+
+    def acquire(self) -> _Database:
+        with self.lock:
+            if len(self.idle):
+                return self.idle.pop()
+        with self.connect_lock:
+            db = _Database(
+                self.database_file_path, check_schema=not self.schema_checked
             )
+            self.schema_checked = True
+        return db
+
+    def release(self, db: _Database) -> None:
+        if db.connection.in_transaction:
+            db.connection.rollback()
+        with self.lock:
+            if len(self.idle) < MAX_IDLE_CONNECTIONS:
+                self.idle.append(db)
+                return
+        db.connection.close()
+
+    def close(self) -> None:
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for db in idle:
+            db.connection.close()
+
+
+_pools: Dict[str, _ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(database_file_path) -> _ConnectionPool:
+    key = str(Path(database_file_path).resolve())
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = _ConnectionPool(database_file_path)
+        return _pools[key]
+
+
+def close_connections() -> None:
+    """
+    Close all idle pooled connections.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
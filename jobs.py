@@ -0,0 +1,208 @@
+import json
+import os
+import sqlite3
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, NamedTuple, Optional, Set
+
+from database import Database
+
+# Number of jobs run at the same time. Jobs writing to the database would wait
+# on each other's write lock, so they are run one at a time.
+MAX_WORKERS = 1
+
+# Seconds between updates of the unfinished jobs of a runner, showing that it
+# is still running them.
+HEARTBEAT_INTERVAL = 10
+
+# Seconds after which an unfinished job that was not updated is considered
+# interrupted: the process running it is gone.
+STALE_AFTER = 60
+
+# Job status, in order.
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Job(NamedTuple):
+    id: int
+    kind: str
+    status: str
+    message: str
+    result: Any = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self._asdict(), finished=self.finished)
+
+
+class JobRunner:
+    """
+    Runs long operations in a thread pool, outside of the Dash callbacks. Each
+    job is recorded in the jobs table of the database, so that its status and
+    result can be looked up by id, e.g. after the page is reloaded.
+
+    A job function is called as `function(report, *args)`, where
+    `report(message)` sets the progress message of the job. Progress is kept in
+    memory: a job importing transactions holds the write lock of the database
+    until it is done. The return value of the function is stored as JSON.
+
+    Jobs run in the process that submitted them, whose id is recorded as
+    their owner. Each worker of the app has its own runner, which updates its
+    unfinished jobs every HEARTBEAT_INTERVAL seconds. Process ids are reused,
+    e.g. in containers, so a job is instead found interrupted when it was not
+    updated for STALE_AFTER seconds.
+    """
+
+    def __init__(self, db_path: str, max_workers: int = MAX_WORKERS):
+        self.db_path = db_path
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self._lock = threading.Lock()
+        self._messages: Dict[int, str] = {}
+        # Unfinished jobs of this runner.
+        self._active: Set[int] = set()
+        self._stopped = threading.Event()
+
+        # Jobs left unfinished by a process that exited were interrupted. Those
+        # of the other workers still running are left alone.
+        self._fail_stale()
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+
+    def submit(self, kind: str, function: Callable, *args) -> int:
+        """
+        Queue a job and return its id.
+        """
+        with Database(self.db_path) as db:
+            now = _now()
+            job_id = db.cursor.execute(
+                "INSERT INTO jobs(kind, status, message, created, updated, owner) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, QUEUED, "Waiting.", now, now, os.getpid()),
+            ).lastrowid
+            db.connection.commit()
+        with self._lock:
+            self._active.add(job_id)
+        self._executor.submit(self._run, job_id, function, *args)
+        return job_id
+
+    def get(self, job_id: int) -> Optional[Job]:
+        query = "SELECT id, kind, status, message, result, updated FROM jobs WHERE id=?"
+        with Database(self.db_path) as db:
+            row = db.cursor.execute(query, (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = Job(*row[:4], result=None if row[4] is None else json.loads(row[4]))
+        if not job.finished and row[5] is not None and row[5] < _now(-STALE_AFTER):
+            # The worker running the job may have exited since this one started.
+            self._fail_stale(job_id)
+            with Database(self.db_path) as db:
+                row = db.cursor.execute(query, (job_id,)).fetchone()
+            job = Job(*row[:4], result=None if row[4] is None else json.loads(row[4]))
+        with self._lock:
+            message = self._messages.get(job_id)
+        if message is not None and not job.finished:
+            job = job._replace(message=message)
+        return job
+
+    def _run(self, job_id: int, function: Callable, *args) -> None:
+        def report(message: str) -> None:
+            with self._lock:
+                self._messages[job_id] = message
+
+        self._set_status(job_id, RUNNING, "Running.")
+        try:
+            result = function(report, *args)
+        except Exception as e:
+            traceback.print_exc()
+            self._set_status(job_id, FAILED, f"Failed: {e}")
+        else:
+            self._set_status(job_id, DONE, "Done.", json.dumps(result))
+        finally:
+            with self._lock:
+                self._messages.pop(job_id, None)
+                self._active.discard(job_id)
+
+    def _set_status(
+        self, job_id: int, status: str, message: str, result: Optional[str] = None
+    ) -> None:
+        with Database(self.db_path) as db:
+            db.cursor.execute(
+                "UPDATE jobs SET status=?, message=?, result=?, updated=? "
+                "WHERE id=?",
+                (status, message, result, _now(), job_id),
+            )
+            db.connection.commit()
+
+    def _fail_stale(self, job_id: Optional[int] = None) -> None:
+        """
+        Mark unfinished jobs not updated for STALE_AFTER seconds as failed, or
+        only `job_id`. The jobs of this runner are kept up to date by its
+        heartbeat, but are left alone in case it was delayed.
+        """
+        now = _now()
+        cutoff = _now(-STALE_AFTER)
+        with Database(self.db_path) as db:
+            rows = db.cursor.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND updated < ?",
+                (QUEUED, RUNNING, cutoff),
+            ).fetchall()
+            with self._lock:
+                stale = [
+                    row[0]
+                    for row in rows
+                    if row[0] not in self._active and job_id in (None, row[0])
+                ]
+            if len(stale) == 0:
+                return
+            # Check again once holding the write lock, in case the job was
+            # updated in the meantime.
+            db.cursor.execute("BEGIN IMMEDIATE")
+            db.cursor.executemany(
+                "UPDATE jobs SET status=?, message=?, updated=? "
+                "WHERE id=? AND status IN (?, ?) AND updated < ?",
+                [
+                    (FAILED, "Interrupted.", now, stale_id, QUEUED, RUNNING, cutoff)
+                    for stale_id in stale
+                ],
+            )
+            db.connection.commit()
+
+    def _heartbeat(self) -> None:
+        while not self._stopped.wait(HEARTBEAT_INTERVAL):
+            with self._lock:
+                active = list(self._active)
+            if len(active) == 0:
+                continue
+            try:
+                with Database(self.db_path) as db:
+                    db.cursor.execute(
+                        "UPDATE jobs SET updated=? "
+                        "WHERE id IN (SELECT value FROM json_each(?)) "
+                        "AND status IN (?, ?)",
+                        (_now(), json.dumps(active), QUEUED, RUNNING),
+                    )
+                    db.connection.commit()
+            except sqlite3.OperationalError as e:
+                # E.g. an import holds the write lock. Other workers cannot mark
+                # the jobs as failed until it is released either.
+                print(f"Job heartbeat not saved: {e}")
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        self._executor.shutdown(wait=True)
+
+
+def _now(offset: float = 0) -> str:
+    """
+    The current time, plus `offset` seconds.
+    """
+    return (datetime.now() + timedelta(seconds=offset)).isoformat(timespec="seconds")
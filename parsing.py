@@ -1,86 +1,366 @@
+import base64
 import csv
+import io
+import multiprocessing
+import os
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice, repeat
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
-from database import Transaction
+from database import ImportResult, Transaction, _Database
+from redaction import DEFAULT_REDACTOR, REDACTED_TRANSACTION_NUMBER, Redactor
 
+# Number of transactions written to the database at a time when importing.
+IMPORT_BATCH_SIZE = 5000
 
-def parse_csv(csv_file_io):
-    transaction_list = []
+
+def parse_csv(csv_file_io, redactor: Redactor = DEFAULT_REDACTOR) -> List[Transaction]:
+    return list(iter_csv(csv_file_io, redactor=redactor))
+
+
+def iter_csv(
+    csv_file_io, redactor: Redactor = DEFAULT_REDACTOR
+) -> Iterator[Transaction]:
+    """
+    Parse transactions one line at a time, without reading the whole file. The
+    bank format is detected once, from the first line, which is skipped if it
+    is a header.
+    """
     reader = csv.reader(csv_file_io)
+    parse_row = None
     for line_num, line in enumerate(reader):
+        if len(line) == 0:
+            continue
+        if parse_row is None:
+            bank_format = detect_format(line)
+            parse_row = bank_format.row_parser(redactor)
+            if bank_format.is_header(line):
+                continue
+        try:
+            yield parse_row(line)
+        except ValueError as e:
+            raise FormatError(f"Line {line_num}: {e} {line}") from e
+
+
+def iter_batches(iterable: Iterable, batch_size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def import_transactions(
+    db: _Database,
+    transactions: Iterable[Transaction],
+    batch_size: int = IMPORT_BATCH_SIZE,
+    progress: Optional[Callable[[ImportResult], None]] = None,
+) -> ImportResult:
+    """
+    Add transactions to the database in batches of `batch_size`, so that only
+    one batch is held in memory at a time. All batches are committed together;
+    if any fails, none are added.
+
+    After each batch, `progress` is called with the running totals.
+    """
+    total = ImportResult(inserted=0, duplicates=0, conflicts=0)
+    try:
+        for batch in iter_batches(transactions, batch_size):
+            result = db.add_transactions(batch, commit=False, warn=False)
+            total = ImportResult(*[a + b for a, b in zip(total, result)])
+            if progress is not None:
+                progress(total)
+    except Exception:
+        db.connection.rollback()
+        raise
+    db.connection.commit()
+    return total
+
+
+class FileImportStatus(NamedTuple):
+    filename: str
+    rows_parsed: int
+    rows_skipped: int
+    error: Optional[str] = None
+
+
+def parse_upload(
+    filename: str, contents: str, redactor: Redactor = DEFAULT_REDACTOR
+) -> Tuple[Optional[str], FileImportStatus]:
+    """
+    Parse the contents of an uploaded csv file, as a base64 data URL. The
+    transactions are written to a temporary file in batches, rather than
+    returned, so that neither this process nor the one importing them holds
+    all of them at once. Returns the path of the temporary file, to be read
+    with `read_parsed` and deleted by the caller.
+
+    Errors are reported in the returned status rather than raised, so that one
+    bad file does not prevent importing the others. No file is left behind on
+    error.
+    """
+    content_type, content_string = contents.split(",", 1)
+    if content_type != "data:text/csv;base64":
+        return None, FileImportStatus(filename, 0, 0, f"Not a csv file: {content_type}")
+    fd, path = tempfile.mkstemp(prefix="import_", suffix=".pickle")
+    n_parsed = 0
+    try:
+        data = base64.b64decode(content_string)
+        csv_file_io = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8", newline="")
+        with open(fd, "wb") as parsed_file:
+            transactions = iter_csv(csv_file_io, redactor=redactor)
+            for batch in iter_batches(transactions, IMPORT_BATCH_SIZE):
+                pickle.dump(batch, parsed_file, protocol=pickle.HIGHEST_PROTOCOL)
+                n_parsed += len(batch)
+    except Exception as e:
+        os.unlink(path)
+        return None, FileImportStatus(filename, 0, 0, str(e))
+    n_lines = sum(1 for line in io.BytesIO(data) if line.strip())
+    status = FileImportStatus(
+        filename=filename,
+        rows_parsed=n_parsed,
+        rows_skipped=n_lines - n_parsed,
+    )
+    return path, status
+
+
+def read_parsed(path: str) -> Iterator[Transaction]:
+    """
+    Transactions written by `parse_upload`, one batch at a time.
+    """
+    with open(path, "rb") as parsed_file:
+        while True:
+            try:
+                batch = pickle.load(parsed_file)
+            except EOFError:
+                return
+            yield from batch
+
+
+def import_uploads(
+    db: _Database,
+    filename_list: List[str],
+    contents_list: List[str],
+    redactor: Redactor = DEFAULT_REDACTOR,
+    max_workers: Optional[int] = None,
+    progress: Optional[Callable[[ImportResult], None]] = None,
+) -> Tuple[ImportResult, List[FileImportStatus]]:
+    """
+    Parse uploaded csv files in parallel, one process per file, then stream
+    their transactions into the database in batches, in one transaction.
+    Transactions appearing in several files are only added once, by the
+    database, and count as duplicates.
+
+    Names stored with the legacy redaction are passed on to the redactor, see
+    `Redactor`.
+
+    Worker processes are started with "spawn": forking a multi-threaded
+    process, such as a server running this as a background job, can copy
+    locks held by other threads.
+    """
+    redactor = redactor.with_legacy_names(get_legacy_redacted_names(db))
+    if len(contents_list) > 1:
+        if max_workers is None:
+            max_workers = min(len(contents_list), os.cpu_count() or 1)
+        with ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results = list(
+                executor.map(
+                    parse_upload, filename_list, contents_list, repeat(redactor)
+                )
+            )
+    else:
+        results = list(
+            map(parse_upload, filename_list, contents_list, repeat(redactor))
+        )
+    path_list = [path for path, _ in results if path is not None]
+    status_list = [status for _, status in results]
+
+    try:
+        transactions = chain.from_iterable(map(read_parsed, path_list))
+        result = import_transactions(db, transactions, progress=progress)
+    finally:
+        for path in path_list:
+            os.unlink(path)
+    return result, status_list
+
+
+def get_legacy_redacted_names(db: _Database) -> List[str]:
+    """
+    Stored names in which the default redaction replaced more than one
+    occurrence of a transaction number. Only the default rules existed then.
+    """
+    result = db.cursor.execute(
+        "SELECT name FROM names WHERE instr(substr(name, instr(name, ?) + ?), ?)",
+        (
+            REDACTED_TRANSACTION_NUMBER,
+            len(REDACTED_TRANSACTION_NUMBER),
+            REDACTED_TRANSACTION_NUMBER,
+        ),
+    )
+    return [row[0] for row in result.fetchall()]
+
+
+class FormatError(ValueError):
+    pass
+
+
+class BankFormat(NamedTuple):
+    """
+    Column layout of a bank's csv export. If `credit_column` is set, the
+    amount is the debit minus the credit.
+    """
+
+    name: str
+    n_columns: int
+    date_column: int
+    name_column: int
+    amount_column: int
+    credit_column: Optional[int] = None
+    redact: bool = False
+
+    def is_header(self, csv_line: List[str]) -> bool:
         try:
-            transaction = parse_line(line)
+            string_to_float(csv_line[self.amount_column])
         except ValueError:
-            if line_num != 0:
-                # Sometimes, the first line is the heading. If casting to float
-                # fails on another line, though, raise the error.
-                print(f"Exception in line {line_num}: {line}")
-                raise
-        except Exception:
-            print(f"Exception in line {line_num}: {line}")
-            raise
+            return True
+        return False
+
+    def row_parser(
+        self, redactor: Redactor = DEFAULT_REDACTOR
+    ) -> Callable[[List[str]], Transaction]:
+        """
+        Returns a function parsing one line of this format.
+        """
+        name = self.name
+        n_columns = self.n_columns
+        date_column = self.date_column
+        name_column = self.name_column
+        amount_column = self.amount_column
+        credit_column = self.credit_column
+        if self.redact:
+            # Names repeat a lot, so each distinct name is only redacted once.
+            redacted = {}
+
+            def clean_name(text: str) -> str:
+                name = redacted.get(text)
+                if name is None:
+                    name = redacted[text] = redactor.redact(text)
+                return name
+
         else:
-            if transaction is not None:
-                transaction_list.append(transaction)
-    return transaction_list
+            clean_name = str
 
+        def check(csv_line):
+            if len(csv_line) != n_columns:
+                raise FormatError(
+                    f"Expected {n_columns} columns for {name} format, "
+                    f"got {len(csv_line)}."
+                )
+
+        if credit_column is None:
+
+            def parse_row(csv_line: List[str]) -> Transaction:
+                check(csv_line)
+                return Transaction(
+                    date=csv_line[date_column],
+                    name=clean_name(csv_line[name_column]),
+                    amount=string_to_float(csv_line[amount_column]),
+                )
 
-def parse_line(csv_line):
-    assert isinstance(csv_line, list)
-    if len(csv_line) == 4:
-        # CIBC
-        return Transaction(
-            date=csv_line[0],
-            name=remove_transaction_number(csv_line[1]),
-            amount=string_to_float(csv_line[2]) - string_to_float(csv_line[3]),
-        )
-    if len(csv_line) == 5:
-        if csv_line[4] == "SPREADSHEET":
-            # Rogers Mastercard from spreadsheet
-            return Transaction(
-                date=csv_line[0],
-                name=csv_line[2],
-                amount=string_to_float(csv_line[4]),
-            )
         else:
-            # CIBC Visa (or old debit)
-            return Transaction(
-                date=csv_line[0],
-                name=remove_transaction_number(csv_line[1]),
-                amount=string_to_float(csv_line[2]) - string_to_float(csv_line[3]),
-            )
-    if len(csv_line) == 12:
-        # Rogers Mastercard
-        return Transaction(
-            date=csv_line[0],
-            name=csv_line[7],
-            amount=string_to_float(csv_line[11]),
-        )
-    if len(csv_line) == 15:
-        # Rogers Mastercard
-        return Transaction(
-            date=csv_line[0],
-            name=csv_line[7],
-            amount=string_to_float(csv_line[12]),
+
+            def parse_row(csv_line: List[str]) -> Transaction:
+                check(csv_line)
+                return Transaction(
+                    date=csv_line[date_column],
+                    name=clean_name(csv_line[name_column]),
+                    amount=string_to_float(csv_line[amount_column])
+                    - string_to_float(csv_line[credit_column]),
+                )
+
+        return parse_row
+
+
+# Each detector takes the first line of a file and returns its format, or None
+# if the line does not match. Detectors are tried in order of registration.
+_format_detectors: List[Callable[[List[str]], Optional[BankFormat]]] = []
+
+
+def register_format(
+    detector: Callable[[List[str]], Optional[BankFormat]]
+) -> Callable[[List[str]], Optional[BankFormat]]:
+    _format_detectors.append(detector)
+    return detector
+
+
+def detect_format(first_line: List[str]) -> BankFormat:
+    for detector in _format_detectors:
+        bank_format = detector(first_line)
+        if bank_format is not None:
+            return bank_format
+    raise FormatError(f"Unknown csv format with {len(first_line)} columns.")
+
+
+@register_format
+def detect_rogers(first_line: List[str]) -> Optional[BankFormat]:
+    header = [column.strip().lower() for column in first_line]
+    if "merchant name" in header and "amount" in header:
+        return BankFormat(
+            name="Rogers Mastercard",
+            n_columns=len(first_line),
+            date_column=header.index("date") if "date" in header else 0,
+            name_column=header.index("merchant name"),
+            amount_column=header.index("amount"),
         )
+    if len(first_line) == 12:
+        return BankFormat("Rogers Mastercard", 12, 0, 7, 11)
+    if len(first_line) == 15:
+        return BankFormat("Rogers Mastercard", 15, 0, 7, 12)
     return None
 
 
+@register_format
+def detect_spreadsheet(first_line: List[str]) -> Optional[BankFormat]:
+    # Rogers Mastercard from spreadsheet, marked in the header.
+    if len(first_line) == 5 and first_line[4] == "SPREADSHEET":
+        return BankFormat("Rogers Mastercard spreadsheet", 5, 0, 2, 4)
+    return None
+
+
+@register_format
+def detect_cibc(first_line: List[str]) -> Optional[BankFormat]:
+    if len(first_line) == 4:
+        return BankFormat("CIBC", 4, 0, 1, 2, credit_column=3, redact=True)
+    if len(first_line) == 5:
+        # CIBC Visa (or old debit)
+        return BankFormat("CIBC Visa", 5, 0, 1, 2, credit_column=3, redact=True)
+    return None
+
+
+def parse_line(csv_line: List[str]) -> Optional[Transaction]:
+    """
+    Parse a single line on its own, detecting its format. Returns None if the
+    format is unknown. To parse a file, use `iter_csv`, which only detects the
+    format once.
+    """
+    assert isinstance(csv_line, list)
+    try:
+        bank_format = detect_format(csv_line)
+    except FormatError:
+        return None
+    return bank_format.row_parser()(csv_line)
+
+
 def remove_transaction_number(name):
     """
     Some CIBC transactions have a unique number in the name, making categorizing
     by name impractical. Remove this number.
     """
-    for match_string in [
-        "Internet Banking INTERNET TRANSFER",
-        "Internet Banking INTERNET BILL PAY",
-        "Electronic Funds Transfer PAY",
-        "Point of Sale - Interac RETAIL PURCHASE",
-    ]:
-        if name.lower().startswith(match_string.lower()):
-            n_words = len(match_string.split(" "))
-            transaction_number = name.split(" ")[n_words]
-            name = name.replace(transaction_number, "__REDACTED_TRANSACTION_NUMBER__")
-    return name
+    return DEFAULT_REDACTOR.redact(name)
 
 
 def string_to_float(string):
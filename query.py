@@ -0,0 +1,134 @@
+import json
+import re
+from typing import Any, Iterable, List, Optional, Tuple
+
+_REGEX_SPECIAL = re.compile(r"[.^$*+?{}\[\]\\|()]")
+_LIKE_SPECIAL = re.compile(r"[%_\\]")
+
+
+class Query:
+    """
+    Builds a SELECT statement with bound parameters. User input never ends up
+    in the SQL text, and a query of the same shape always produces the same
+    text, so SQLite can reuse its prepared statement.
+
+    Example:
+        sql, params = (
+            Query("bank_records")
+            .where_in("category", ["food", "rent"])
+            .where_date_range("2023-01-01", None)
+            .order_by("date DESC")
+            .build()
+        )
+    """
+
+    def __init__(self, table: str, columns: str = "*"):
+        self.table = table
+        self.columns = columns
+        self._where: List[str] = []
+        self._params: List[Any] = []
+        self._group_by: Optional[str] = None
+        self._order_by: Optional[str] = None
+        self._limit: Optional[Tuple[int, int]] = None
+
+    def where(self, clause: str, *params: Any) -> "Query":
+        """
+        Add a condition, with a ? placeholder for each parameter.
+        """
+        self._where.append(clause)
+        self._params.extend(params)
+        return self
+
+    def where_in(self, column: str, values: Iterable[Any]) -> "Query":
+        """
+        Condition on the column being one of the values. The values are bound
+        as a single JSON array, so the SQL does not depend on their number.
+        """
+        return self.where(
+            f"{column} IN (SELECT value FROM json_each(?))", json.dumps(list(values))
+        )
+
+    def where_category(self, category: Optional[str]) -> "Query":
+        """
+        Condition on the category, where "*" matches any category and None
+        matches ignored transactions.
+        """
+        if category == "*":
+            return self.where("category IS NOT NULL")
+        if category is None:
+            return self.where("category IS NULL")
+        return self.where("category=?", category)
+
+    def where_name_matches(self, text: Optional[str]) -> "Query":
+        """
+        Condition on the name containing a text or matching a regex, ignoring
+        case. The match is done on the distinct names in the names table, and
+        the transactions are then looked up by name.
+
+        An empty text adds no condition. Text without regex special characters
+        uses LIKE, which runs without calling back into Python. An invalid
+        regex is searched for as plain text.
+        """
+        if text is None or text == "":
+            return self
+        if _REGEX_SPECIAL.search(text) is not None:
+            try:
+                re.compile(text)
+            except re.error:
+                pass
+            else:
+                return self.where(
+                    "name IN (SELECT name FROM names WHERE name REGEXP ?)", text
+                )
+        pattern = _LIKE_SPECIAL.sub(r"\\\g<0>", text)
+        return self.where(
+            "name IN (SELECT name FROM names WHERE name LIKE ? ESCAPE '\\')",
+            f"%{pattern}%",
+        )
+
+    def where_date_range(
+        self, start_date: Optional[str], end_date: Optional[str]
+    ) -> "Query":
+        """
+        Condition on the date being in the range. Missing bounds are ignored.
+        """
+        if start_date is not None:
+            self.where("date >= ?", start_date)
+        if end_date is not None:
+            self.where("date <= ?", end_date)
+        return self
+
+    def group_by(self, columns: str) -> "Query":
+        self._group_by = columns
+        return self
+
+    def order_by(self, columns: str) -> "Query":
+        self._order_by = columns
+        return self
+
+    def limit(self, n_rows: int, offset: int = 0) -> "Query":
+        self._limit = (n_rows, offset)
+        return self
+
+    def build_count(self) -> Tuple[str, List[Any]]:
+        """
+        Count the rows matching the conditions, ignoring order and limit.
+        """
+        sql = f"SELECT COUNT(*) FROM {self.table}"
+        if len(self._where):
+            sql += " WHERE " + " AND ".join(self._where)
+        return sql, list(self._params)
+
+    def build(self) -> Tuple[str, List[Any]]:
+        sql = f"SELECT {self.columns} FROM {self.table}"
+        if len(self._where):
+            sql += " WHERE " + " AND ".join(self._where)
+        if self._group_by is not None:
+            sql += f" GROUP BY {self._group_by}"
+        if self._order_by is not None:
+            sql += f" ORDER BY {self._order_by}"
+        params = list(self._params)
+        if self._limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend(self._limit)
+        return sql, params
@@ -0,0 +1,141 @@
+import json
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Tuple, Union
+
+REDACTED_TRANSACTION_NUMBER = "__REDACTED_TRANSACTION_NUMBER__"
+
+
+class RedactionRule(NamedTuple):
+    """
+    A regex matching a noisy identifier in a transaction name. The text of the
+    first group is replaced, or the whole match if the pattern has no groups.
+    Patterns are combined into one regex, so they may not use numbered
+    backreferences.
+    """
+
+    pattern: str
+    replacement: str = REDACTED_TRANSACTION_NUMBER
+    ignore_case: bool = True
+
+
+# Some CIBC transactions have a unique number in the name, following one of
+# these prefixes.
+DEFAULT_RULES = [
+    RedactionRule(rf"^{re.escape(prefix)} ([^ ]+)")
+    for prefix in [
+        "Internet Banking INTERNET TRANSFER",
+        "Internet Banking INTERNET BILL PAY",
+        "Electronic Funds Transfer PAY",
+        "Point of Sale - Interac RETAIL PURCHASE",
+    ]
+]
+
+
+def load_rules(path: Union[str, Path]) -> List[RedactionRule]:
+    """
+    Load rules from a JSON file containing a list of objects with a "pattern"
+    and, optionally, a "replacement" and "ignore_case".
+
+    Example: [{"pattern": "^PAYPAL \\*([0-9]+)", "replacement": "__ID__"}]
+    """
+    with open(path) as f:
+        rule_dict_list = json.load(f)
+    return [RedactionRule(**rule_dict) for rule_dict in rule_dict_list]
+
+
+class Redactor:
+    """
+    Applies redaction rules to names. All rules are compiled into a single
+    alternation, so each name is scanned once regardless of the number of
+    rules.
+
+    Before rules existed, every occurrence of an identifier in a name was
+    replaced, e.g. "RETAIL PURCHASE 4455 STORE 4455" was stored as
+    "RETAIL PURCHASE __ID__ STORE __ID__". The identifier is lost, so these
+    names cannot be redacted again. If such a name is among `legacy_names`,
+    it is kept for the transactions it was stored for, so that they are still
+    recognized as duplicates and keep their category.
+    """
+
+    def __init__(
+        self, rules: Iterable[RedactionRule], legacy_names: Iterable[str] = ()
+    ):
+        self.rules = list(rules)
+        self.legacy_names = frozenset(legacy_names)
+
+        # Wrap each rule in a group, to know which rule matched. Map the index
+        # of that group to the rule and to its number of groups.
+        self._rule_by_group: Dict[int, Tuple[RedactionRule, int]] = {}
+        pattern_list = []
+        group = 1
+        for rule in self.rules:
+            n_groups = re.compile(rule.pattern).groups
+            flags = "i" if rule.ignore_case else ""
+            pattern_list.append(f"((?{flags}:{rule.pattern}))")
+            self._rule_by_group[group] = (rule, n_groups)
+            group += 1 + n_groups
+        if len(pattern_list):
+            self.pattern = re.compile("|".join(pattern_list))
+        else:
+            self.pattern = None
+
+    @classmethod
+    def from_file(
+        cls, path: Union[str, Path], include_defaults: bool = True
+    ) -> "Redactor":
+        rules = load_rules(path)
+        if include_defaults:
+            rules = DEFAULT_RULES + rules
+        return cls(rules)
+
+    def with_legacy_names(self, legacy_names: Iterable[str]) -> "Redactor":
+        return Redactor(self.rules, legacy_names=legacy_names)
+
+    def _replace(self, match: re.Match) -> str:
+        rule, n_groups = self._rule_by_group[match.lastindex]
+        if n_groups == 0:
+            return rule.replacement
+        start, end = match.span(match.lastindex + 1)
+        if start == -1:
+            # The group did not participate in the match.
+            return match.group(0)
+        offset = match.start()
+        text = match.group(0)
+        return text[: start - offset] + rule.replacement + text[end - offset :]
+
+    def redact(self, name: str) -> str:
+        if self.pattern is None:
+            return name
+        redacted = self.pattern.sub(self._replace, name)
+        if len(self.legacy_names) and redacted != name:
+            legacy_name = self._redact_every_occurrence(name)
+            if legacy_name in self.legacy_names:
+                return legacy_name
+        return redacted
+
+    def redact_many(self, name_list: Iterable[str]) -> List[str]:
+        """
+        Redact a list of names. Names repeat a lot, so each distinct name is
+        only redacted once.
+        """
+        name_list = list(name_list)
+        redacted = dict.fromkeys(name_list)
+        for name in redacted:
+            redacted[name] = self.redact(name)
+        return [redacted[name] for name in name_list]
+
+    def _redact_every_occurrence(self, name: str) -> str:
+        """
+        Redact names the way they were before rules existed: every occurrence
+        of the text matched by a rule is replaced.
+        """
+        for match in self.pattern.finditer(name):
+            rule, n_groups = self._rule_by_group[match.lastindex]
+            text = match.group(match.lastindex + 1 if n_groups else 0)
+            if text:
+                name = name.replace(text, rule.replacement)
+        return name
+
+
+DEFAULT_REDACTOR = Redactor(DEFAULT_RULES)
@@ -1,34 +1,90 @@
 # Run this app with `python run.py` and
 # visit http://127.0.0.1:8050/ in your web browser.
+#
+# To serve it with several workers, use a WSGI server such as gunicorn:
+#   ACCOUNTANT_DB_PATH=/path/to/db.sql gunicorn -w 4 --threads 4 "run:create_app()"
 
 
-import base64
-import io
+import functools
+import os
+from pathlib import Path
+from typing import Optional
 
 import dash
 import dash_bootstrap_components as dbc
+import flask
 from dash import Dash, dash_table, dcc, html, no_update
 from dash.dependencies import Input, Output, State
 
 from database import Database
-from parsing import parse_csv
-from state import Basic, Plot, Table, Uncategorized
+from jobs import JobRunner
+from parsing import import_uploads
+from redaction import DEFAULT_REDACTOR, Redactor
+from sessions import SessionStore
 
-# Database path is hardcoded.
-DB_PATH = "/home/eugene/.local/bank_records/db.sql"
+# Database path, unless set by the ACCOUNTANT_DB_PATH environment variable.
+DEFAULT_DB_PATH = "~/.local/bank_records/db.sql"
 
-# State is kept here.
-state_basic = Basic(DB_PATH)
-state_table = Table(DB_PATH, table_id="transaction_table")
-state_table_modal = Table(
-    DB_PATH, table_id="query_table", group_by_name=True, row_selectable="multi"
-)
-state_plot = Plot(DB_PATH)
-state_uncategorized = Uncategorized(DB_PATH)
+# Cookie holding the session id of the browser.
+SESSION_COOKIE = "accountant_session"
+
+
+def load_redactor(db_path: str) -> Redactor:
+    """
+    Optional user-defined rules for redacting noisy identifiers from names, next
+    to the database.
+    """
+    redaction_rules_path = Path(db_path).parent.joinpath("redaction_rules.json")
+    if redaction_rules_path.exists():
+        return Redactor.from_file(redaction_rules_path)
+    return DEFAULT_REDACTOR
+
+
+def current_db_path() -> str:
+    return flask.current_app.config["DB_PATH"]
+
+
+def current_job_runner() -> JobRunner:
+    return flask.current_app.config["JOB_RUNNER"]
+
+
+def current_session_id() -> str:
+    """
+    Session id of the request. A new session id is made for a browser without
+    one, and set as a cookie on the response.
+    """
+    session_id = flask.request.cookies.get(SESSION_COOKIE)
+    if session_id is None:
+        session_id = flask.g.get("new_session_id")
+    if session_id is None:
+        session_id = flask.g.new_session_id = SessionStore.new_session_id()
+    return session_id
+
+
+def set_session_cookie(response: flask.Response) -> flask.Response:
+    session_id = flask.g.get("new_session_id")
+    if session_id is not None:
+        response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite="Lax")
+    return response
+
+
+def with_session(callback):
+    """
+    Pass the state of the session of the request to a callback, as its first
+    argument.
+    """
+
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        sessions = flask.current_app.config["SESSIONS"]
+        with sessions.use(current_session_id()) as session:
+            return callback(session, *args, **kwargs)
+
+    return wrapper
 
 
 # Modal dialogue uses state.
-def get_next_modal_body():
+def get_next_modal_body(session):
     try:
         (
             name,
@@ -37,12 +93,27 @@ def get_next_modal_body():
             tx_example,
             n_done,
             n_total,
-        ) = state_uncategorized.get_name_to_process()
+        ) = session.uncategorized.get_name_to_process()
     except StopIteration:
+        name = None
         message = "No uncategorized transactions"
         similar_names = []
         options = []
     else:
+        if similar_names is None:
+            similar_names_message = "Similar names loading..."
+            similar_names = []
+        elif session.uncategorized.name_similarity.error is not None:
+            similar_names_message = (
+                "Error computing similar names: "
+                f"{session.uncategorized.name_similarity.error}"
+            )
+        else:
+            similar_names_message = ""
+        suggestions = session.uncategorized.get_suggestions(name)
+        suggestions_message = ", ".join(
+            f"{category} ({probability:.0%})" for category, probability in suggestions
+        )
         message = [
             html.P(
                 [
@@ -56,489 +127,618 @@ def get_next_modal_body():
                     html.Br(),
                     html.Br(),
                     f"Name {n_done} / {n_total}; {count} occurrences.",
+                    html.Br(),
+                    f"Suggested: {suggestions_message}" if suggestions else "",
                 ]
             ),
+            html.P(html.I(similar_names_message)),
         ]
-        similar_names = []
-        options = state_basic.get_categories()
+        options = session.basic.get_categories()
         options = [c for c in options if c != "__UNKNOWN__"]
-    return message, similar_names, options
-
-
-# The app accesses and updates the state.
-app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
-app.layout = html.Div(
-    children=[
-        html.Div(id="hidden_refresh1", style={"display": "none"}),
-        html.Div(id="hidden_refresh2", style={"display": "none"}),
-        html.Div(id="hidden_refresh3", style={"display": "none"}),
-        html.Div(id="hidden_refresh4", style={"display": "none"}),
-        html.Div(id="hidden_refresh5", style={"display": "none"}),
-        html.Div(id="hidden_refresh6", style={"display": "none"}),
-        html.Div(id="hidden_refresh7", style={"display": "none"}),
-        html.Div(
-            [
-                dcc.Upload(
-                    id="upload_csv",
-                    children=html.Div(["Import CSV files (click or drag and drop)"]),
-                    style={
-                        "width": "31%",
-                        "height": "60px",
-                        "lineHeight": "60px",
-                        "borderWidth": "1px",
-                        "borderStyle": "dashed",
-                        "borderRadius": "5px",
-                        "textAlign": "center",
-                        "margin": "1%",
-                        "float": "left",
-                    },
-                    # Allow multiple files to be uploaded
-                    multiple=True,
-                ),
-                html.Button(
-                    "Categorize unknown",
-                    id="button_categorize",
-                    style={
-                        "width": "31%",
-                        "height": "60px",
-                        "lineHeight": "60px",
-                        "borderWidth": "2px",
-                        "borderStyle": "solid",
-                        "borderRadius": "5px",
-                        "textAlign": "center",
-                        "margin": "1%",
-                        "float": "left",
-                    },
-                ),
-                html.Button(
-                    "Regex query",
-                    id="button_query",
-                    style={
-                        "width": "31%",
-                        "height": "60px",
-                        "lineHeight": "60px",
-                        "borderWidth": "2px",
-                        "borderStyle": "solid",
-                        "borderRadius": "5px",
-                        "textAlign": "center",
-                        "margin": "1%",
-                        "float": "left",
-                    },
-                ),
-                dbc.Modal(
-                    [
-                        dbc.ModalHeader(html.B("Set a category")),
-                        dbc.ModalBody(
-                            id="modal_categorize_body",
-                            children=[
-                                html.Div("", id="modal_categorize_message"),
-                                html.Div(
-                                    [
-                                        dcc.RadioItems(
-                                            state_basic.get_categories(),
-                                            labelStyle={"display": "block"},
-                                            id="modal_categorize_radio_items",
-                                        ),
-                                        dcc.Input(
-                                            type="text",
-                                            debounce=True,
-                                            id="modal_categorize_text",
-                                        ),
-                                    ],
-                                    style={
-                                        "width": "28%",
-                                        "margin": "1%",
-                                        "float": "left",
-                                    },
-                                ),
-                                html.Div(
-                                    [
-                                        html.B("Select similar names:"),
-                                        dcc.Checklist(
-                                            id="checklist_similar_names",
-                                            labelStyle={"display": "block"},
-                                            options=[],
-                                        ),
-                                    ],
-                                    style={
-                                        "width": "68%",
-                                        "margin": "1%",
-                                        "float": "right",
-                                    },
-                                ),
-                            ],
+    return name, message, similar_names, options
+
+
+def make_layout(session):
+    return html.Div(
+        children=[
+            html.Div(id="hidden_refresh1", style={"display": "none"}),
+            html.Div(id="hidden_refresh2", style={"display": "none"}),
+            html.Div(id="hidden_refresh3", style={"display": "none"}),
+            html.Div(id="hidden_refresh4", style={"display": "none"}),
+            html.Div(id="hidden_refresh5", style={"display": "none"}),
+            html.Div(id="hidden_refresh6", style={"display": "none"}),
+            html.Div(id="hidden_refresh7", style={"display": "none"}),
+            # Versions of the states last rendered on this page.
+            dcc.Store(id="rendered_versions", data={}),
+            # Name shown in the categorize dialogue of this page.
+            dcc.Store(id="categorize_name"),
+            # Import job of this browser, kept across page reloads.
+            dcc.Store(id="import_job_id", storage_type="local"),
+            dcc.Interval(id="interval_import_job", interval=1000, disabled=True),
+            # Bulk category changes of this page, run as jobs.
+            dcc.Store(id="auto_categorize_job_id"),
+            dcc.Interval(
+                id="interval_auto_categorize_job", interval=1000, disabled=True
+            ),
+            html.Div(id="auto_categorize_done", style={"display": "none"}),
+            dcc.Store(id="convert_job_id"),
+            dcc.Interval(id="interval_convert_job", interval=1000, disabled=True),
+            html.Div(
+                [
+                    dcc.Upload(
+                        id="upload_csv",
+                        children=html.Div(
+                            ["Import CSV files (click or drag and drop)"]
                         ),
-                        dbc.ModalFooter(
-                            html.Div(
-                                [
-                                    dbc.Button(
-                                        "Skip",
-                                        id="button_skip_modal_categorize",
-                                        className="ms-auto",
-                                        style={
-                                            "margin": "1%",
-                                            "float": "right",
-                                        },
-                                    ),
-                                    dbc.Button(
-                                        "Undo",
-                                        id="button_undo_modal_categorize",
-                                        className="ms-auto",
+                        style={
+                            "width": "31%",
+                            "height": "60px",
+                            "lineHeight": "60px",
+                            "borderWidth": "1px",
+                            "borderStyle": "dashed",
+                            "borderRadius": "5px",
+                            "textAlign": "center",
+                            "margin": "1%",
+                            "float": "left",
+                        },
+                        # Allow multiple files to be uploaded
+                        multiple=True,
+                    ),
+                    html.Button(
+                        "Categorize unknown",
+                        id="button_categorize",
+                        style={
+                            "width": "31%",
+                            "height": "60px",
+                            "lineHeight": "60px",
+                            "borderWidth": "2px",
+                            "borderStyle": "solid",
+                            "borderRadius": "5px",
+                            "textAlign": "center",
+                            "margin": "1%",
+                            "float": "left",
+                        },
+                    ),
+                    html.Button(
+                        "Regex query",
+                        id="button_query",
+                        style={
+                            "width": "31%",
+                            "height": "60px",
+                            "lineHeight": "60px",
+                            "borderWidth": "2px",
+                            "borderStyle": "solid",
+                            "borderRadius": "5px",
+                            "textAlign": "center",
+                            "margin": "1%",
+                            "float": "left",
+                        },
+                    ),
+                    dbc.Modal(
+                        [
+                            dbc.ModalHeader(html.B("Set a category")),
+                            dbc.ModalBody(
+                                id="modal_categorize_body",
+                                children=[
+                                    html.Div("", id="modal_categorize_message"),
+                                    html.Div(
+                                        [
+                                            dcc.RadioItems(
+                                                session.basic.get_categories(),
+                                                labelStyle={"display": "block"},
+                                                id="modal_categorize_radio_items",
+                                            ),
+                                            dcc.Input(
+                                                type="text",
+                                                debounce=True,
+                                                id="modal_categorize_text",
+                                            ),
+                                        ],
                                         style={
+                                            "width": "28%",
                                             "margin": "1%",
-                                            "float": "right",
+                                            "float": "left",
                                         },
                                     ),
-                                    dbc.Button(
-                                        "Ignore",
-                                        id="button_ignore_modal_categorize",
-                                        className="ms-auto",
-                                        color="danger",
+                                    html.Div(
+                                        [
+                                            html.B("Select similar names:"),
+                                            dcc.Checklist(
+                                                id="checklist_similar_names",
+                                                labelStyle={"display": "block"},
+                                                options=[],
+                                            ),
+                                            # Refresh the similar names until they
+                                            # are done loading.
+                                            dcc.Interval(
+                                                id="interval_similar_names",
+                                                interval=1000,
+                                                disabled=True,
+                                            ),
+                                        ],
                                         style={
+                                            "width": "68%",
                                             "margin": "1%",
                                             "float": "right",
                                         },
                                     ),
                                 ],
-                                style={"width": "100%"},
                             ),
-                        ),
-                    ],
-                    id="modal_categorize",
-                    is_open=False,
-                    size="xl",
-                ),
-                dbc.Modal(
-                    [
-                        dbc.ModalHeader(
-                            [
-                                html.B("Categorization by regex name query"),
-                            ]
-                        ),
-                        dbc.ModalBody(
-                            id="modal_query_body",
-                            children=[
+                            dbc.ModalFooter(
                                 html.Div(
                                     [
-                                        html.B("Name query (regex)"),
-                                        dcc.Input(
-                                            type="text",
-                                            debounce=True,
-                                            id="modal_query_text",
+                                        dbc.Button(
+                                            "Auto-apply suggestions",
+                                            id="button_auto_modal_categorize",
                                             style={
-                                                "overflow": "auto",
-                                                "width": "100%",
+                                                "margin": "1%",
+                                                "float": "left",
                                             },
                                         ),
-                                    ],
-                                    style={
-                                        "width": "32%",
-                                        "margin": "1%",
-                                        "float": "left",
-                                    },
-                                ),
-                                html.Div(
-                                    [
-                                        html.Button(
-                                            "Convert",
-                                            id="button_convert",
+                                        html.Div(
+                                            [
+                                                "above ",
+                                                dcc.Input(
+                                                    type="number",
+                                                    min=0,
+                                                    max=100,
+                                                    value=95,
+                                                    id="input_auto_confidence",
+                                                    style={"width": "5em"},
+                                                ),
+                                                "% confidence",
+                                            ],
                                             style={
-                                                "width": "98%",
-                                                "height": "98%",
-                                                "lineHeight": "60px",
-                                                "borderWidth": "2px",
-                                                "borderStyle": "solid",
-                                                "borderRadius": "5px",
-                                                "textAlign": "center",
                                                 "margin": "1%",
-                                                "float": "center",
+                                                "float": "left",
                                             },
                                         ),
-                                    ],
-                                    style={
-                                        "width": "8%",
-                                        "margin": "1%",
-                                        "float": "right",
-                                    },
-                                ),
-                                html.Div(
-                                    [
-                                        html.B("Create category"),
-                                        dcc.Input(
-                                            type="text",
-                                            debounce=False,
-                                            id="input_create_category",
-                                            style={"width": "100%"},
+                                        html.Div(
+                                            id="auto_categorize_status",
+                                            style={
+                                                "margin": "1%",
+                                                "float": "left",
+                                            },
                                         ),
-                                    ],
-                                    style={
-                                        "width": "16%",
-                                        "margin": "1%",
-                                        "float": "right",
-                                    },
-                                ),
-                                html.Div(
-                                    [
-                                        html.B("Target category"),
-                                        dcc.Dropdown(
-                                            id="modal_query_target_dropdown",
-                                            options=state_basic.get_categories(),
-                                            clearable=True,
+                                        dbc.Button(
+                                            "Skip",
+                                            id="button_skip_modal_categorize",
+                                            className="ms-auto",
                                             style={
-                                                "width": "100%",
+                                                "margin": "1%",
+                                                "float": "right",
                                             },
                                         ),
-                                    ],
-                                    style={
-                                        "width": "16%",
-                                        "margin": "1%",
-                                        "float": "right",
-                                    },
-                                ),
-                                html.Div(
-                                    [
-                                        html.B("Source category"),
-                                        dcc.Dropdown(
-                                            id="modal_query_source_dropdown",
-                                            value="*",
-                                            options=["*"]
-                                            + state_basic.get_categories(),
-                                            clearable=True,
+                                        dbc.Button(
+                                            "Undo",
+                                            id="button_undo_modal_categorize",
+                                            className="ms-auto",
+                                            style={
+                                                "margin": "1%",
+                                                "float": "right",
+                                            },
+                                        ),
+                                        dbc.Button(
+                                            "Ignore",
+                                            id="button_ignore_modal_categorize",
+                                            className="ms-auto",
+                                            color="danger",
                                             style={
-                                                "width": "100%",
+                                                "margin": "1%",
+                                                "float": "right",
                                             },
                                         ),
                                     ],
-                                    style={
-                                        "width": "16%",
-                                        "margin": "1%",
-                                        "float": "right",
-                                    },
-                                ),
-                            ],
-                        ),
-                        dbc.ModalFooter(
-                            [
-                                dcc.Checklist(
-                                    id="select_all_checklist",
-                                    options=["Select all"],
-                                    style={"float": "left"},
+                                    style={"width": "100%"},
                                 ),
-                                html.Div(
-                                    [state_table_modal.get_table()],
-                                    style={
-                                        "width": "100%",
-                                        "float": "center",
-                                    },
-                                    id="modal_query_container",
-                                ),
-                            ],
-                        ),
-                    ],
-                    id="modal_query",
-                    is_open=False,
-                    size="xl",
-                ),
-            ],
-            style={"height": "80px"},
-        ),
-        dcc.Graph(
-            id="pie_chart",
-            figure=state_plot.get_fig_pie(),
-            style={"float": "left"},
-        ),
-        dcc.Graph(
-            id="line_plot",
-            figure=state_plot.get_fig_line(),
-            style={"float": "right"},
-        ),
-        html.Div(
-            style={
-                "width": "100%",
-                "float": "left",
-            }
-        ),
-        html.Div(
-            [
-                html.Div(
-                    [
-                        html.B("Date range"),
-                        html.Br(),
-                        dcc.DatePickerRange(
-                            id="date_picker_range",
-                            clearable=True,
-                        ),
-                    ],
-                    style={"float": "left", "margin": "1%"},
-                ),
-                html.Div(
-                    [
-                        html.B("Year"),
-                        html.Br(),
-                        dcc.Dropdown(
-                            id="year_dropdown",
-                            options=state_basic.get_year_list(),
-                            clearable=True,
-                        ),
-                    ],
-                    style={"float": "left", "width": "10%", "margin": "1%"},
-                ),
-                html.Div(
-                    [
-                        html.B("Interval"),
-                        html.Br(),
-                        dcc.RadioItems(
-                            ["Annual", "Monthly"],
-                            value="Annual",
-                            labelStyle={"display": "block"},
-                            id="radio_interval",
-                        ),
-                    ],
-                    style={"float": "left", "width": "10%", "margin": "1%"},
-                ),
-                html.Div(
-                    [
-                        html.B("Filter categories"),
-                        html.Br(),
-                        html.Button("Select", id="button_select_categories"),
-                    ],
-                    style={"float": "left", "width": "10%", "margin": "1%"},
-                ),
-                html.Div(
-                    [
-                        html.B("Extrapolate final year"),
-                        html.Br(),
+                            ),
+                        ],
+                        id="modal_categorize",
+                        is_open=False,
+                        size="xl",
+                    ),
+                    dbc.Modal(
+                        [
+                            dbc.ModalHeader(
+                                [
+                                    html.B("Categorization by regex name query"),
+                                ]
+                            ),
+                            dbc.ModalBody(
+                                id="modal_query_body",
+                                children=[
+                                    html.Div(
+                                        [
+                                            html.B("Name query (regex)"),
+                                            dcc.Input(
+                                                type="text",
+                                                debounce=True,
+                                                id="modal_query_text",
+                                                style={
+                                                    "overflow": "auto",
+                                                    "width": "100%",
+                                                },
+                                            ),
+                                        ],
+                                        style={
+                                            "width": "32%",
+                                            "margin": "1%",
+                                            "float": "left",
+                                        },
+                                    ),
+                                    html.Div(
+                                        [
+                                            html.Button(
+                                                "Convert",
+                                                id="button_convert",
+                                                style={
+                                                    "width": "98%",
+                                                    "height": "98%",
+                                                    "lineHeight": "60px",
+                                                    "borderWidth": "2px",
+                                                    "borderStyle": "solid",
+                                                    "borderRadius": "5px",
+                                                    "textAlign": "center",
+                                                    "margin": "1%",
+                                                    "float": "center",
+                                                },
+                                            ),
+                                            html.Div(id="convert_status"),
+                                        ],
+                                        style={
+                                            "width": "8%",
+                                            "margin": "1%",
+                                            "float": "right",
+                                        },
+                                    ),
+                                    html.Div(
+                                        [
+                                            html.B("Create category"),
+                                            dcc.Input(
+                                                type="text",
+                                                debounce=False,
+                                                id="input_create_category",
+                                                style={"width": "100%"},
+                                            ),
+                                        ],
+                                        style={
+                                            "width": "16%",
+                                            "margin": "1%",
+                                            "float": "right",
+                                        },
+                                    ),
+                                    html.Div(
+                                        [
+                                            html.B("Target category"),
+                                            dcc.Dropdown(
+                                                id="modal_query_target_dropdown",
+                                                options=session.basic.get_categories(),
+                                                clearable=True,
+                                                style={
+                                                    "width": "100%",
+                                                },
+                                            ),
+                                        ],
+                                        style={
+                                            "width": "16%",
+                                            "margin": "1%",
+                                            "float": "right",
+                                        },
+                                    ),
+                                    html.Div(
+                                        [
+                                            html.B("Source category"),
+                                            dcc.Dropdown(
+                                                id="modal_query_source_dropdown",
+                                                value="*",
+                                                options=["*"]
+                                                + session.basic.get_categories(),
+                                                clearable=True,
+                                                style={
+                                                    "width": "100%",
+                                                },
+                                            ),
+                                        ],
+                                        style={
+                                            "width": "16%",
+                                            "margin": "1%",
+                                            "float": "right",
+                                        },
+                                    ),
+                                ],
+                            ),
+                            dbc.ModalFooter(
+                                [
+                                    dcc.Checklist(
+                                        id="select_all_checklist",
+                                        options=["Select all"],
+                                        style={"float": "left"},
+                                    ),
+                                    html.Div(
+                                        [session.table_modal.get_table()],
+                                        style={
+                                            "width": "100%",
+                                            "float": "center",
+                                        },
+                                        id="modal_query_container",
+                                    ),
+                                ],
+                            ),
+                        ],
+                        id="modal_query",
+                        is_open=False,
+                        size="xl",
+                    ),
+                ],
+                style={"height": "80px"},
+            ),
+            html.Div(id="upload_status", style={"margin": "1%"}),
+            dcc.Graph(
+                id="pie_chart",
+                figure=session.plot.get_fig_pie(),
+                style={"float": "left"},
+            ),
+            dcc.Graph(
+                id="line_plot",
+                figure=session.plot.get_fig_line(),
+                style={"float": "right"},
+            ),
+            html.Div(
+                style={
+                    "width": "100%",
+                    "float": "left",
+                }
+            ),
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            html.B("Date range"),
+                            html.Br(),
+                            dcc.DatePickerRange(
+                                id="date_picker_range",
+                                clearable=True,
+                            ),
+                        ],
+                        style={"float": "left", "margin": "1%"},
+                    ),
+                    html.Div(
+                        [
+                            html.B("Year"),
+                            html.Br(),
+                            dcc.Dropdown(
+                                id="year_dropdown",
+                                options=session.basic.get_year_list(),
+                                clearable=True,
+                            ),
+                        ],
+                        style={"float": "left", "width": "10%", "margin": "1%"},
+                    ),
+                    html.Div(
+                        [
+                            html.B("Interval"),
+                            html.Br(),
+                            dcc.RadioItems(
+                                ["Annual", "Monthly"],
+                                value="Annual",
+                                labelStyle={"display": "block"},
+                                id="radio_interval",
+                            ),
+                        ],
+                        style={"float": "left", "width": "10%", "margin": "1%"},
+                    ),
+                    html.Div(
+                        [
+                            html.B("Filter categories"),
+                            html.Br(),
+                            html.Button("Select", id="button_select_categories"),
+                        ],
+                        style={"float": "left", "width": "10%", "margin": "1%"},
+                    ),
+                    html.Div(
+                        [
+                            html.B("Extrapolate final year"),
+                            html.Br(),
+                            dcc.Checklist(
+                                id="checklist_extrapolate_year",
+                                options=["Extrapolate"],
+                                style={"float": "left"},
+                            ),
+                        ],
+                        style={"float": "left", "width": "12%", "margin": "1%"},
+                    ),
+                ],
+                style={"float": "left", "width": "100%", "margin": "1%"},
+            ),
+            html.Div(
+                [
+                    html.B("Filter table"),
+                    html.Br(),
+                    dcc.Input(
+                        type="text",
+                        debounce=True,
+                        id="table_filter_text",
+                        style={
+                            "overflow": "auto",
+                            "width": "100%",
+                        },
+                    ),
+                ],
+                style={"float": "left", "width": "95%", "margin": "1%"},
+            ),
+            dbc.Modal(
+                [
+                    dbc.ModalHeader(
+                        [
+                            html.B("Select categories to display"),
+                        ]
+                    ),
+                    dbc.ModalBody(
                         dcc.Checklist(
-                            id="checklist_extrapolate_year",
-                            options=["Extrapolate"],
+                            id="select_all_categories_checklist",
+                            options=["Select all"],
+                            value=["Select all"],
                             style={"float": "left"},
                         ),
-                    ],
-                    style={"float": "left", "width": "12%", "margin": "1%"},
-                ),
-            ],
-            style={"float": "left", "width": "100%", "margin": "1%"},
-        ),
-        html.Div(
-            [
-                html.B("Filter table"),
-                html.Br(),
-                dcc.Input(
-                    type="text",
-                    debounce=True,
-                    id="table_filter_text",
-                    style={
-                        "overflow": "auto",
-                        "width": "100%",
-                    },
-                ),
-            ],
-            style={"float": "left", "width": "95%", "margin": "1%"},
-        ),
-        dbc.Modal(
-            [
-                dbc.ModalHeader(
-                    [
-                        html.B("Select categories to display"),
-                    ]
-                ),
-                dbc.ModalBody(
-                    dcc.Checklist(
-                        id="select_all_categories_checklist",
-                        options=["Select all"],
-                        value=["Select all"],
-                        style={"float": "left"},
                     ),
-                ),
-                dbc.ModalFooter(
-                    [
-                        html.Div(
-                            dcc.Checklist(
-                                options=state_basic.get_categories(),
-                                value=state_basic.get_categories(),
-                                labelStyle={"display": "block"},
-                                id="modal_checklist_category_selection",
+                    dbc.ModalFooter(
+                        [
+                            html.Div(
+                                dcc.Checklist(
+                                    options=session.basic.get_categories(),
+                                    value=session.basic.get_categories(),
+                                    labelStyle={"display": "block"},
+                                    id="modal_checklist_category_selection",
+                                ),
+                                style={
+                                    "width": "100%",
+                                    "float": "center",
+                                },
                             ),
-                            style={
-                                "width": "100%",
-                                "float": "center",
-                            },
-                        ),
-                    ],
-                ),
-            ],
-            id="modal_select_categories",
-            is_open=False,
-            size="sm",
-        ),
-        html.Br(),
-        html.Div(
-            [
-                html.Div(
-                    html.B("No category selected"),
-                    id="transaction_table_category",
-                ),
-                html.Div(
-                    # dash_table.DataTable(
-                    # id="transaction_table",
-                    # columns=[{"name": "empty", "id": "empty"}],
-                    # ),
-                    state_table.get_table(),
-                    id="transaction_table_container",
-                ),
-            ],
-            style={"width": "100%", "float": "left", "margin": "1%"},
-        ),
-    ],
-)
+                        ],
+                    ),
+                ],
+                id="modal_select_categories",
+                is_open=False,
+                size="sm",
+            ),
+            html.Br(),
+            html.Div(
+                [
+                    html.Div(
+                        html.B("No category selected"),
+                        id="transaction_table_category",
+                    ),
+                    html.Div(
+                        # dash_table.DataTable(
+                        # id="transaction_table",
+                        # columns=[{"name": "empty", "id": "empty"}],
+                        # ),
+                        session.table.get_table(),
+                        id="transaction_table_container",
+                    ),
+                ],
+                style={"width": "100%", "float": "left", "margin": "1%"},
+            ),
+        ],
+    )
 
 
-@app.callback(
-    Output("year_dropdown", "options"),
-    Output("hidden_refresh6", "children"),
+def serve_layout():
+    """
+    Layout of the page, with the state of the session of the request.
+    """
+    if not flask.has_request_context():
+        # Dash checks the layout when it is set, outside of any request. The
+        # state of a session is not saved until it is used in a request.
+        sessions = flask.current_app.config["SESSIONS"]
+        return make_layout(sessions.get(SessionStore.new_session_id()))
+    return with_session(make_layout)()
+
+
+def format_import_status(result, status_list):
+    lines = []
+    for status in status_list:
+        if status.error is not None:
+            lines.append(f"{status.filename}: not imported. {status.error}")
+        else:
+            lines.append(
+                f"{status.filename}: {status.rows_parsed} transactions, "
+                f"{status.rows_skipped} lines skipped."
+            )
+    lines.append(
+        f"Imported {result.inserted} transactions "
+        f"({result.duplicates} duplicates, {result.conflicts} conflicts)."
+    )
+    return lines
+
+
+def import_job(report, db_path, redactor, filename_list, contents_list):
+    """
+    Parse and import uploaded csv files. Returns the lines of the import status.
+    """
+
+    def progress(result):
+        report(f"Imported {result.inserted} transactions...")
+
+    with Database(db_path) as db:
+        result, status_list = import_uploads(
+            db, filename_list, contents_list, redactor=redactor, progress=progress
+        )
+    return format_import_status(result, status_list)
+
+
+def job_status(job_id):
+    job = current_job_runner().get(job_id)
+    if job is None:
+        return flask.jsonify(error=f"No job {job_id}."), 404
+    return flask.jsonify(job.to_dict())
+
+
+@dash.callback(
+    Output("import_job_id", "data"),
     Input("upload_csv", "contents"),
+    State("upload_csv", "filename"),
     prevent_initial_call=True,
 )
-def upload_csv_callback(contents_list):
+def upload_csv_callback(contents_list, filename_list):
     if contents_list is None:
-        return no_update, None
-
-    # Parse all transactions from csv files.
-    transaction_import_list = []
-    for contents in contents_list:
-        content_type, content_string = contents.split(",")
-        if content_type != "data:text/csv;base64":
-            continue
-        try:
-            decoded_string = io.StringIO(
-                base64.b64decode(content_string).decode("utf-8")
-            )
-            transaction_list = parse_csv(decoded_string)
-        except Exception as e:
-            print(e)
-            pass
-        else:
-            transaction_import_list.extend(transaction_list)
+        return no_update
+
+    # Parse the csv files and add their transactions to the database in the
+    # background, so that the page stays responsive.
+    return current_job_runner().submit(
+        "import",
+        import_job,
+        current_db_path(),
+        flask.current_app.config["REDACTOR"],
+        filename_list,
+        contents_list,
+    )
+
 
-    # Add transactions to database. This skips transactions that already
-    # exist in the database.
-    with Database(DB_PATH) as db:
-        db.add_transactions(transaction_import_list)
+@dash.callback(
+    Output("year_dropdown", "options"),
+    Output("hidden_refresh6", "children"),
+    Output("upload_status", "children"),
+    Output("interval_import_job", "disabled"),
+    Input("import_job_id", "data"),
+    Input("interval_import_job", "n_intervals"),
+)
+@with_session
+def import_job_callback(session, job_id, n_intervals):
+    if job_id is None:
+        return no_update, no_update, no_update, True
+    job = current_job_runner().get(job_id)
+    if job is None:
+        return no_update, no_update, None, True
+    if not job.finished:
+        return no_update, no_update, html.Div(job.message), False
+    if job.result is None:
+        return no_update, no_update, html.Div(job.message), True
 
     # Get the list of years in the DB.
-    return state_basic.get_year_list(), None
+    session.basic.update()
+    return (
+        session.basic.get_year_list(),
+        None,
+        [html.Div(line) for line in job.result],
+        True,
+    )
 
 
-@app.callback(
+@dash.callback(
     Output("pie_chart", "figure"),
     Output("line_plot", "figure"),
     Output("transaction_table_container", "children"),
     Output("modal_checklist_category_selection", "options"),
+    Output("rendered_versions", "data"),
     Input("modal_categorize", "is_open"),  # Wait for callback
     Input("modal_query", "is_open"),  # Wait for callback
     Input("modal_select_categories", "is_open"),  # Wait for callback
     State("modal_checklist_category_selection", "value"),
     Input("table_filter_text", "value"),
+    State("rendered_versions", "data"),
     Input("date_picker_range", "start_date"),  # Wait for callback
     Input("date_picker_range", "end_date"),  # Wait for callback
     Input("year_dropdown", "value"),  # Wait for callback
@@ -550,12 +750,15 @@ def upload_csv_callback(contents_list):
     Input("hidden_refresh7", "children"),  # Wait for callback
     prevent_initial_call=True,
 )
+@with_session
 def refresh_all_callback(
+    session,
     categorize_modal_open,
     query_modal_open,
     select_modal_open,
     category_selection,
     table_filter,
+    rendered_versions,
     *args,
     **kwargs,
 ):
@@ -563,65 +766,162 @@ def refresh_all_callback(
 
     if trigger_id == "modal_categorize" and categorize_modal_open is True:
         # Update only when the modal is closed, not when it is opened.
-        return no_update, no_update, no_update, no_update
+        return (no_update,) * 5
 
     if trigger_id == "modal_query" and query_modal_open is True:
         # Update only when the modal is closed, not when it is opened.
-        return no_update, no_update, no_update, no_update
+        return (no_update,) * 5
 
     if trigger_id == "modal-select_categories" and select_modal_open is True:
         # Update only when the modal is closed, not when it is opened.
-        return no_update, no_update, no_update, no_update
+        return (no_update,) * 5
 
     if trigger_id == "table_filter_text":
         if table_filter is None:
             table_filter = ""
-        state_table.set_regex_query(table_filter)
-
-    # Update all states.
-    state_basic.update()
-    state_table.update()
-    state_table_modal.update()
-    state_plot.update()
-    state_uncategorized.update()
+        session.table.set_regex_query(table_filter)
+
+    # Update category selection, before the plot is rendered.
+    session.plot.set_category_list(category_selection)
+
+    # Update all states. Each only recomputes if its data or filters changed.
+    session.basic.update()
+    session.table.update()
+    session.table_modal.update()
+    session.plot.update()
+    session.uncategorized.update()
+
+    # Only send the outputs whose state changed since they were last sent to
+    # this page.
+    if rendered_versions is None:
+        rendered_versions = {}
+    versions = {
+        "session": session.instance,
+        "plot": session.plot.version,
+        "table": session.table.version,
+        "basic": session.basic.version,
+    }
+    # A page may have been rendered from another worker's copy of the session.
+    if rendered_versions.get("session") != session.instance:
+        rendered_versions = {}
+    changed = {
+        key: rendered_versions.get(key) != version for key, version in versions.items()
+    }
+    return (
+        session.plot.get_fig_pie() if changed["plot"] else no_update,
+        session.plot.get_fig_line() if changed["plot"] else no_update,
+        [session.table.get_table()] if changed["table"] else no_update,
+        session.basic.get_categories() if changed["basic"] else no_update,
+        versions,
+    )
 
-    # Update category selection.
-    state_plot.set_category_list(category_selection)
 
-    return (
-        state_plot.get_fig_pie(),
-        state_plot.get_fig_line(),
-        [state_table.get_table()],
-        state_basic.get_categories(),
+def auto_categorize_job(report, sessions, session_id, min_confidence):
+    """
+    Set the suggested categories above a confidence threshold, for the queue of
+    a session. The session is only held while the categories are applied, so
+    that its other requests are served while the suggestions are computed.
+    """
+    report("Computing suggestions...")
+    category_by_name = sessions.name_similarity.get_confident_categories(
+        min_confidence
     )
+    report(f"Applying {len(category_by_name)} categories...")
+    with sessions.use(session_id) as session:
+        n_categorized = session.uncategorized.apply_categories(category_by_name)
+    return f"Categorized {n_categorized} names."
+
+
+def set_categories_job(report, db_path, category_by_name):
+    with Database(db_path) as db:
+        db.set_categories(category_by_name)
+    return f"Set the category of {len(category_by_name)} names."
+
+
+def poll_category_job(job_id):
+    """
+    Outputs of the callbacks following a job changing categories in bulk: the
+    job id once it is done, to refresh the views, its status and whether to
+    stop polling.
+    """
+    if job_id is None:
+        return no_update, no_update, True
+    job = current_job_runner().get(job_id)
+    if job is None:
+        return no_update, None, True
+    if not job.finished:
+        return no_update, job.message, False
+    if job.result is None:
+        return no_update, job.message, True
+    return job_id, job.result, True
+
+
+@dash.callback(
+    Output("auto_categorize_job_id", "data"),
+    Input("button_auto_modal_categorize", "n_clicks"),
+    State("input_auto_confidence", "value"),
+    prevent_initial_call=True,
+)
+def auto_categorize_callback(n_clicks, auto_confidence):
+    if auto_confidence is None:
+        return no_update
+    return current_job_runner().submit(
+        "auto_categorize",
+        auto_categorize_job,
+        flask.current_app.config["SESSIONS"],
+        current_session_id(),
+        auto_confidence / 100,
+    )
+
+
+@dash.callback(
+    Output("auto_categorize_done", "children"),
+    Output("auto_categorize_status", "children"),
+    Output("interval_auto_categorize_job", "disabled"),
+    Input("auto_categorize_job_id", "data"),
+    Input("interval_auto_categorize_job", "n_intervals"),
+    prevent_initial_call=True,
+)
+def auto_categorize_job_callback(job_id, n_intervals):
+    return poll_category_job(job_id)
 
 
-@app.callback(
+@dash.callback(
     Output("modal_categorize", "is_open"),
     Output("modal_categorize_message", "children"),
     Output("checklist_similar_names", "options"),
     Output("modal_categorize_radio_items", "options"),
     Output("modal_categorize_radio_items", "value"),
     Output("modal_categorize_text", "value"),
+    Output("interval_similar_names", "disabled"),
+    Output("categorize_name", "data"),
     Input("button_categorize", "n_clicks"),
     Input("button_ignore_modal_categorize", "n_clicks"),
     Input("button_undo_modal_categorize", "n_clicks"),
     Input("button_skip_modal_categorize", "n_clicks"),
+    Input("auto_categorize_done", "children"),
     Input("modal_categorize_radio_items", "value"),
     Input("modal_categorize_text", "value"),
+    Input("interval_similar_names", "n_intervals"),
     State("modal_categorize", "is_open"),
     State("checklist_similar_names", "value"),
+    State("categorize_name", "data"),
     prevent_initial_call=True,
 )
+@with_session
 def categorize_callback(
+    session,
     n_clicks_open,
     n_clicks_ignore,
     n_clicks_undo,
     n_clicks_skip,
+    auto_categorize_job_id,
     category,
     new_category,
+    n_intervals,
     is_open,
     selected_similar_names,
+    name,
 ):
     ctx = dash.callback_context
     trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
@@ -634,25 +934,47 @@ def categorize_callback(
 
     # Ignore button pressed. Set a None category.
     elif trigger_id == "button_ignore_modal_categorize":
-        state_uncategorized.set_category(None, selected_similar_names)
+        session.uncategorized.set_category(name, None, selected_similar_names)
 
     # Undo previous action.
     elif trigger_id == "button_undo_modal_categorize":
-        state_uncategorized.undo()
+        session.uncategorized.undo()
 
     # Skip button pressed. Skip to next iteration by doing nothing on this one.
     elif trigger_id == "button_skip_modal_categorize":
-        state_uncategorized.skip()
+        session.uncategorized.skip(name)
+
+    # Suggested categories were applied by a job. Show the next name.
+    elif trigger_id == "auto_categorize_done":
+        pass
 
     # If a radio item is selected within the modal dialog.
     elif trigger_id == "modal_categorize_radio_items":
-        state_uncategorized.set_category(category, selected_similar_names)
+        session.uncategorized.set_category(name, category, selected_similar_names)
 
     # Entered a new category.
     elif trigger_id == "modal_categorize_text":
         if new_category != "":
             # Avoid empty string category. Do nothing.
-            state_uncategorized.set_category(new_category, selected_similar_names)
+            session.uncategorized.set_category(
+                name, new_category, selected_similar_names
+            )
+
+    # Check whether similar names are done loading.
+    elif trigger_id == "interval_similar_names":
+        if not session.uncategorized.name_similarity.ready.is_set():
+            return (no_update,) * 8
+        name, message, similar_names, options = get_next_modal_body(session)
+        return (
+            no_update,
+            message,
+            similar_names,
+            no_update,
+            no_update,
+            no_update,
+            True,
+            name,
+        )
 
     # Initial null trigger on app start.
     elif len(trigger_id) == 0:
@@ -663,12 +985,23 @@ def categorize_callback(
         raise Exception(f"Unexpected callback trigger: {trigger_id}")
 
     # Update the message and radio items options.
-    message, similar_names, options = get_next_modal_body()
+    name, message, similar_names, options = get_next_modal_body(session)
+    loaded = session.uncategorized.name_similarity.ready.is_set()
+    interval_disabled = loaded or not set_is_open
 
-    return set_is_open, message, similar_names, options, None, ""
+    return (
+        set_is_open,
+        message,
+        similar_names,
+        options,
+        None,
+        "",
+        interval_disabled,
+        name,
+    )
 
 
-@app.callback(
+@dash.callback(
     Output("modal_query", "is_open"),
     Input("button_query", "n_clicks"),
     State("modal_query", "is_open"),
@@ -690,7 +1023,7 @@ def query_callback(
     return set_is_open
 
 
-@app.callback(
+@dash.callback(
     Output("transaction_table_category", "children"),
     Input(component_id="pie_chart", component_property="clickData"),
     Input("date_picker_range", "start_date"),
@@ -698,31 +1031,33 @@ def query_callback(
     Input("year_dropdown", "value"),
     prevent_initial_call=True,
 )
-def click_pie_chart_callback(click_data, start_date, end_date, year):
+@with_session
+def click_pie_chart_callback(session, click_data, start_date, end_date, year):
     trigger_id = dash.callback_context.triggered[0]["prop_id"].split(".")[0]
     if trigger_id == "pie_chart":
         category = click_data["points"][0]["label"]
-        state_table.set_category(category)
+        session.table.set_category(category)
     if trigger_id == "date_picker_range":
-        state_table.set_date_range(start_date, end_date)
+        session.table.set_date_range(start_date, end_date)
     if trigger_id == "year_dropdown":
-        state_table.set_year(year)
-    return html.B(state_table.category)
+        session.table.set_year(year)
+    return html.B(session.table.category)
 
 
-@app.callback(
+@dash.callback(
     Output("hidden_refresh1", "children"),
     Input("radio_interval", "value"),
     prevent_initial_call=True,
 )
-def radio_interval_callback(value):
+@with_session
+def radio_interval_callback(session, value):
     if value == "Annual":
-        state_plot.set_interval("YS")
+        session.plot.set_interval("YS")
     elif value == "Monthly":
-        state_plot.set_interval("MS")
+        session.plot.set_interval("MS")
 
 
-@app.callback(
+@dash.callback(
     Output("date_picker_range", "start_date"),
     Output("date_picker_range", "end_date"),
     Output("year_dropdown", "value"),
@@ -731,54 +1066,68 @@ def radio_interval_callback(value):
     Input("year_dropdown", "value"),
     prevent_initial_call=True,
 )
-def date_picker_range_callback(start_date, end_date, year):
+@with_session
+def date_picker_range_callback(session, start_date, end_date, year):
     ctx = dash.callback_context
     trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
     if trigger_id == "date_picker_range":
-        state_plot.set_date_range(start_date, end_date)
+        session.plot.set_date_range(start_date, end_date)
         year = None
     if trigger_id == "year_dropdown":
-        state_plot.set_year(year)
-    return state_plot.start_date, state_plot.end_date, year
+        session.plot.set_year(year)
+    return session.plot.start_date, session.plot.end_date, year
+
+
+@dash.callback(
+    Output("transaction_table", "data"),
+    Output("transaction_table", "page_count"),
+    Input("transaction_table", "page_current"),
+    Input("transaction_table", "sort_by"),
+    prevent_initial_call=True,
+)
+@with_session
+def transaction_table_page_callback(session, page_current, sort_by):
+    session.table.set_page(page_current, sort_by)
+    return session.table.records, session.table.page_count
 
 
-@app.callback(
+@dash.callback(
     Output("hidden_refresh2", "children"),
     Input("transaction_table", "data"),
+    State("transaction_table", "data_previous"),
     prevent_initial_call=True,
 )
-def transaction_table_change_callback(data):
+@with_session
+def transaction_table_change_callback(session, data, data_previous):
     if data is None:
         return
-    diff = state_table.diff(data)
-    if diff is not None:
-        with Database(DB_PATH) as db:
-            db.set_name_category(
-                name=diff["name"],
-                category=diff["category"],
-            )
-        state_table.update()
+    changed = session.table.diff(data, data_previous)
+    if len(changed):
+        with Database(current_db_path()) as db:
+            db.set_categories({row["name"]: row["category"] for row in changed})
+        session.table.update()
     return
 
 
-@app.callback(
+@dash.callback(
     Output("hidden_refresh3", "children"),
     Input("modal_query_text", "value"),
     Input("modal_query_source_dropdown", "value"),
     prevent_initial_call=True,
 )
-def query_table_callback(query, source_category):
+@with_session
+def query_table_callback(session, query, source_category):
     trigger_id = dash.callback_context.triggered[0]["prop_id"].split(".")[0]
     if trigger_id == "modal_query_text":
         if query is None:
             query = ""
-        state_table_modal.set_regex_query(query)
+        session.table_modal.set_regex_query(query)
     if trigger_id == "modal_query_source_dropdown":
-        state_table_modal.set_category(source_category)
+        session.table_modal.set_category(source_category)
     return
 
 
-@app.callback(
+@dash.callback(
     Output("query_table", "selected_rows"),
     Input("select_all_checklist", "value"),
     State("query_table", "data"),
@@ -791,27 +1140,26 @@ def select_all_callback(select_all, table_data):
     return selected_rows
 
 
-@app.callback(
+@dash.callback(
     Output("hidden_refresh4", "children"),
     Input("query_table", "data"),
+    State("query_table", "data_previous"),
     prevent_initial_call=True,
 )
-def query_table_change_callback(data):
+@with_session
+def query_table_change_callback(session, data, data_previous):
     if data is None:
         return
-    diff = state_table_modal.diff(data)
-    if diff is not None:
-        with Database(DB_PATH) as db:
-            db.set_name_category(
-                name=diff["name"],
-                category=diff["category"],
-            )
-        state_table_modal.update()
+    changed = session.table_modal.diff(data, data_previous)
+    if len(changed):
+        with Database(current_db_path()) as db:
+            db.set_categories({row["name"]: row["category"] for row in changed})
+        session.table_modal.update()
     return
 
 
-@app.callback(
-    Output("hidden_refresh5", "children"),
+@dash.callback(
+    Output("convert_job_id", "data"),
     Input("button_convert", "n_clicks"),
     State("modal_query_target_dropdown", "value"),
     State("input_create_category", "value"),
@@ -823,21 +1171,32 @@ def convert_button_callback(
     n_clicks, category_dropdown, category_create, selected_rows, rows
 ):
     if len(selected_rows) == 0:
-        return
+        return no_update
     if category_create is not None and category_create != "":
         category = category_create
     else:
         category = category_dropdown
-    for idx in selected_rows:
-        with Database(DB_PATH) as db:
-            db.set_name_category(
-                name=rows[idx]["name"],
-                category=category,
-            )
-    return
+    return current_job_runner().submit(
+        "set_categories",
+        set_categories_job,
+        current_db_path(),
+        {rows[idx]["name"]: category for idx in selected_rows},
+    )
 
 
-@app.callback(
+@dash.callback(
+    Output("hidden_refresh5", "children"),
+    Output("convert_status", "children"),
+    Output("interval_convert_job", "disabled"),
+    Input("convert_job_id", "data"),
+    Input("interval_convert_job", "n_intervals"),
+    prevent_initial_call=True,
+)
+def convert_job_callback(job_id, n_intervals):
+    return poll_category_job(job_id)
+
+
+@dash.callback(
     Output("modal_query_target_dropdown", "value"),
     Output("input_create_category", "value"),
     Input("modal_query_target_dropdown", "value"),
@@ -852,7 +1211,7 @@ def clear_dropdown_or_input_field(dropdown_value, input_value):
         return None, no_update
 
 
-@app.callback(
+@dash.callback(
     Output("modal_query_container", "children"),
     Output("modal_query_target_dropdown", "options"),
     Output("modal_query_source_dropdown", "options"),
@@ -862,19 +1221,20 @@ def clear_dropdown_or_input_field(dropdown_value, input_value):
     Input("hidden_refresh5", "children"),
     prevent_initial_call=True,
 )
-def refresh_query_table(*args, **kwargs):
-    state_table_modal.update()
-    state_uncategorized.update()
-    categories = state_basic.get_categories()
+@with_session
+def refresh_query_table(session, *args, **kwargs):
+    session.table_modal.update()
+    session.uncategorized.update()
+    categories = session.basic.get_categories()
     return (
-        [state_table_modal.get_table()],
+        [session.table_modal.get_table()],
         categories,
         ["*"] + categories,
         [],
     )
 
 
-@app.callback(
+@dash.callback(
     Output("modal_select_categories", "is_open"),
     Input("button_select_categories", "n_clicks"),
     State("modal_categorize", "is_open"),
@@ -889,7 +1249,7 @@ def categorize_callback(
     return is_open
 
 
-@app.callback(
+@dash.callback(
     Output("modal_checklist_category_selection", "value"),
     Input("select_all_categories_checklist", "value"),
     State("modal_checklist_category_selection", "options"),
@@ -901,21 +1261,57 @@ def select_all_callback(select_all, options):
     return []
 
 
-@app.callback(
+@dash.callback(
     Output("hidden_refresh7", "children"),
     Input("checklist_extrapolate_year", "value"),
 )
-def extrapolate_year_callback(extrapolate_value):
+@with_session
+def extrapolate_year_callback(session, extrapolate_value):
     if extrapolate_value == ["Extrapolate"]:
-        state_plot.set_extrapolate(True)
+        session.plot.set_extrapolate(True)
     else:
-        state_plot.set_extrapolate(False)
+        session.plot.set_extrapolate(False)
+
+
+def backup_job(report, db_path):
+    with Database(db_path) as db:
+        db.backup(compress=True)
+
+
+def create_app(db_path: Optional[str] = None) -> Dash:
+    """
+    Make the app for a database file, by default the one given by the
+    ACCOUNTANT_DB_PATH environment variable. The app is a WSGI application.
+
+    The state of each browser session is kept by a SessionStore, and long
+    operations are run by a JobRunner, both stored in the config of the Flask
+    server. The callbacks are registered with the first app made in a process.
+
+    Each app makes a backup of the database in the background, so that
+    startup does not wait on it. With several workers, backups after the
+    first are skipped, since a backup with the same hash exists.
+    """
+    if db_path is None:
+        db_path = os.environ.get("ACCOUNTANT_DB_PATH", DEFAULT_DB_PATH)
+    db_path = str(Path(db_path).expanduser())
+
+    app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
+    app.server.config.update(
+        DB_PATH=db_path,
+        REDACTOR=load_redactor(db_path),
+        SESSIONS=SessionStore(db_path),
+        JOB_RUNNER=JobRunner(db_path),
+    )
+    with app.server.app_context():
+        app.layout = serve_layout
+    app.server.after_request(set_session_cookie)
+    app.server.add_url_rule("/jobs/<int:job_id>", view_func=job_status)
+    app.server.config["JOB_RUNNER"].submit("backup", backup_job, db_path)
+    return app
 
 
 if __name__ == "__main__":
-    # Make a backup.
-    with Database(DB_PATH) as db:
-        db.backup()
+    app = create_app()
 
     # Run app.
-    app.run_server(debug=True)
+    app.run(debug=True)
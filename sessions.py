@@ -0,0 +1,147 @@
+import json
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator
+
+from database import Database
+from state import Basic, NameSimilarity, Plot, Table, Uncategorized
+
+# Number of sessions whose state is kept in memory by each worker.
+MAX_SESSIONS = 32
+
+# Transactions are sent to the browser one page at a time.
+TABLE_PAGE_SIZE = 100
+
+
+class Session:
+    """
+    State of the app for one browser session.
+
+    The similarity index of uncategorized names is shared by all sessions of a
+    worker: it is expensive to build, and only depends on the database. Each
+    session has its own queue of names to categorize.
+    """
+
+    def __init__(
+        self, db_path: str, session_id: str, name_similarity: NameSimilarity
+    ):
+        self.session_id = session_id
+        # Identifies this copy of the session, since each worker has its own.
+        self.instance = uuid.uuid4().hex
+        self.lock = threading.RLock()
+        self.revision = 0
+        self.saved_params = None
+        self.basic = Basic(db_path)
+        self.table = Table(
+            db_path, table_id="transaction_table", page_size=TABLE_PAGE_SIZE
+        )
+        self.table_modal = Table(
+            db_path, table_id="query_table", group_by_name=True, row_selectable="multi"
+        )
+        self.plot = Plot(db_path)
+        self.uncategorized = Uncategorized(db_path, name_similarity)
+
+    def get_params(self) -> dict:
+        return {
+            "table": self.table.get_params(),
+            "table_modal": self.table_modal.get_params(),
+            "plot": self.plot.get_params(),
+            "uncategorized": self.uncategorized.get_params(),
+        }
+
+    def set_params(self, params: dict) -> None:
+        self.table.set_params(params.get("table", {}))
+        self.table_modal.set_params(params.get("table_modal", {}))
+        self.plot.set_params(params.get("plot", {}))
+        self.uncategorized.set_params(params.get("uncategorized", {}))
+
+
+class SessionStore:
+    """
+    Sessions of one worker, by session id. The least recently used sessions
+    are dropped from memory.
+
+    The parameters of each session are saved in the sessions table, so that
+    any worker serving a request of the session sees the filters, page, plot
+    settings and categorize history chosen in requests served by the other
+    workers.
+    """
+
+    def __init__(self, db_path: str, max_sessions: int = MAX_SESSIONS):
+        self.db_path = db_path
+        self.max_sessions = max_sessions
+        self.name_similarity = NameSimilarity(db_path)
+        self._sessions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_session_id() -> str:
+        return uuid.uuid4().hex
+
+    def get(self, session_id: str) -> Session:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(self.db_path, session_id, self.name_similarity)
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+        return session
+
+    @contextmanager
+    def use(self, session_id: str) -> Iterator[Session]:
+        """
+        Use the state of a session, up to date with its saved parameters. The
+        parameters are saved on exit if they changed. Requests of a session are
+        served one at a time by each worker.
+        """
+        session = self.get(session_id)
+        with session.lock:
+            self._load(session)
+            yield session
+            self._save(session)
+
+    def _load(self, session: Session) -> None:
+        with Database(self.db_path) as db:
+            row = db.cursor.execute(
+                "SELECT revision, params FROM sessions WHERE id=?",
+                (session.session_id,),
+            ).fetchone()
+        if row is None or row[0] <= session.revision:
+            return
+        session.revision = row[0]
+        session.saved_params = json.loads(row[1])
+        session.set_params(session.saved_params)
+
+    def _save(self, session: Session) -> None:
+        params = session.get_params()
+        if params == session.saved_params:
+            return
+        try:
+            with Database(self.db_path) as db:
+                revision = db.cursor.execute(
+                    "INSERT INTO sessions(id, revision, params, updated) "
+                    "VALUES (?, 1, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET revision = revision + 1, "
+                    "params = excluded.params, updated = excluded.updated "
+                    "RETURNING revision",
+                    (
+                        session.session_id,
+                        json.dumps(params),
+                        datetime.now().isoformat(timespec="seconds"),
+                    ),
+                ).fetchone()[0]
+                db.connection.commit()
+        except sqlite3.OperationalError as e:
+            # E.g. an import holds the write lock. The parameters are saved
+            # with the next change.
+            print(f"Session parameters not saved: {e}")
+            return
+        session.revision = revision
+        session.saved_params = params
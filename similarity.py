@@ -0,0 +1,230 @@
+import os
+import re
+from bisect import insort
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+import numpy as np
+from fuzzywuzzy import fuzz
+
+# Names are similar if the fuzz.ratio of their keys is above this threshold.
+SIMILARITY_THRESHOLD = 75
+
+# Size of the n-grams used to find candidate keys. With bigrams, every pair of
+# keys above the threshold shares at least one n-gram (see `_candidates`).
+NGRAM_SIZE = 2
+
+# Maximum number of neighbours kept per key.
+MAX_NEIGHBOURS = 100
+
+_NON_LETTERS = re.compile(r"[\W\d]+")
+
+
+def name_key(name: str) -> str:
+    """
+    Names are compared using only their letters, in lower case.
+    """
+    return _NON_LETTERS.sub("", name.lower())
+
+
+def ngrams(key: str) -> Counter:
+    padding = "\0" * (NGRAM_SIZE - 1)
+    padded = f"{padding}{key}{padding}"
+    return Counter(
+        padded[i : i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)
+    )
+
+
+class SimilarityIndex:
+    """
+    Finds the keys whose fuzz.ratio with a given key is above a threshold,
+    without comparing it to every key. An inverted index of n-grams gives the
+    candidate keys, which are filtered by length and number of shared n-grams
+    before the exact ratio is computed.
+    """
+
+    def __init__(self, keys: Iterable[str] = (), threshold=SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self._ngrams: Dict[str, Counter] = {}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._neighbours: Dict[str, List[Tuple[str, int]]] = {}
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._ngrams
+
+    def __len__(self) -> int:
+        return len(self._ngrams)
+
+    def add(self, key: str) -> None:
+        """
+        Add a key. Neighbours already computed for other keys are updated, so
+        only the similarities of the new key are computed.
+        """
+        if key in self._ngrams:
+            return
+        key_ngrams = ngrams(key)
+        self._ngrams[key] = key_ngrams
+        for gram, count in key_ngrams.items():
+            self._postings.setdefault(gram, {})[key] = count
+        if len(self._neighbours):
+            self._add_to_neighbours(key)
+
+    def remove(self, key: str) -> None:
+        """
+        Remove a key. It is dropped lazily from the neighbours of other keys.
+        """
+        key_ngrams = self._ngrams.pop(key, None)
+        if key_ngrams is None:
+            return
+        for gram in key_ngrams:
+            del self._postings[gram][key]
+        self._neighbours.pop(key, None)
+
+    def _add_to_neighbours(self, key: str) -> None:
+        """
+        Insert `key` in the computed neighbours of the keys similar to it.
+        """
+        self.neighbours(key)
+        for other in self._candidates(key):
+            other_neighbours = self._neighbours.get(other)
+            if other_neighbours is None:
+                continue
+            # Removed keys are left in the neighbours, and may be added back.
+            if any(neighbour == key for neighbour, _ in other_neighbours):
+                continue
+            # fuzz.ratio is not always symmetric; compare in the same order as
+            # `neighbours` does.
+            ratio = fuzz.ratio(other, key)
+            if ratio > self.threshold:
+                insort(other_neighbours, (key, ratio), key=_sort_key)
+                del other_neighbours[MAX_NEIGHBOURS:]
+
+    def _candidates(self, key: str) -> Iterator[str]:
+        """
+        Keys that may have a ratio with `key` above the threshold.
+
+        A ratio above the threshold bounds the number of edits between two keys,
+        and each edit changes at most NGRAM_SIZE n-grams. Keys sharing too few
+        n-grams are skipped without computing their ratio.
+        """
+        key_ngrams = self._ngrams.get(key)
+        if key_ngrams is None:
+            key_ngrams = ngrams(key)
+        n_shared = Counter()
+        for gram, count in key_ngrams.items():
+            for other, other_count in self._postings.get(gram, {}).items():
+                n_shared[other] += min(count, other_count)
+
+        # fuzz.ratio rounds to an integer, so a ratio above the threshold is at
+        # least threshold + 0.5 before rounding.
+        min_ratio = self.threshold + 0.5
+        for other, n in n_shared.items():
+            if other == key:
+                continue
+            length_sum = len(key) + len(other)
+            if 200 * min(len(key), len(other)) < min_ratio * length_sum:
+                continue
+            max_edits = int(length_sum * (100 - min_ratio) / 100)
+            max_length = max(len(key), len(other))
+            if n < max_length + NGRAM_SIZE - 1 - NGRAM_SIZE * max_edits:
+                continue
+            yield other
+
+    def neighbours(self, key: str) -> List[Tuple[str, int]]:
+        """
+        Keys similar to `key` and their ratio, most similar first, up to
+        MAX_NEIGHBOURS. The key itself is excluded.
+        """
+        if key in self._neighbours:
+            return [
+                (other, ratio)
+                for other, ratio in self._neighbours[key]
+                if other in self._ngrams
+            ]
+
+        result = []
+        for other in self._candidates(key):
+            ratio = fuzz.ratio(key, other)
+            if ratio > self.threshold:
+                result.append((other, ratio))
+        result.sort(key=_sort_key)
+        del result[MAX_NEIGHBOURS:]
+        if key in self._ngrams:
+            self._neighbours[key] = result
+        return list(result)
+
+    def compute_all(self) -> None:
+        for key in self._ngrams:
+            self.neighbours(key)
+
+    def save(self, path: Union[str, Path]) -> None:
+        """
+        Save the computed neighbours as a sparse matrix in a .npz file: row i
+        lists the neighbours of keys[i] as indices into keys, with their
+        ratios. The file is replaced atomically.
+        """
+        keys = list(self._ngrams)
+        index = {key: i for i, key in enumerate(keys)}
+        computed = np.zeros(len(keys), dtype=bool)
+        indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+        neighbour_list = []
+        ratio_list = []
+        for i, key in enumerate(keys):
+            if key in self._neighbours:
+                computed[i] = True
+                for other, ratio in self.neighbours(key):
+                    neighbour_list.append(index[other])
+                    ratio_list.append(ratio)
+            indptr[i + 1] = len(neighbour_list)
+
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                threshold=np.array(self.threshold),
+                keys=np.array(keys, dtype=str),
+                computed=computed,
+                indptr=indptr,
+                neighbours=np.array(neighbour_list, dtype=np.int32),
+                ratios=np.array(ratio_list, dtype=np.uint8),
+            )
+        os.replace(tmp_path, path)
+
+    def load(self, path: Union[str, Path]) -> bool:
+        """
+        Load neighbours saved by `save` for the keys in this index. The
+        neighbours of keys missing from the file are computed, and inserted in
+        the loaded neighbours. Returns False if the file cannot be used.
+        """
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if data["threshold"].item() != self.threshold:
+                    return False
+                keys = data["keys"].tolist()
+                computed = data["computed"]
+                indptr = data["indptr"]
+                neighbours = data["neighbours"]
+                ratios = data["ratios"].tolist()
+        except (OSError, ValueError, KeyError):
+            return False
+
+        for i, key in enumerate(keys):
+            if computed[i] and key in self._ngrams:
+                start, end = indptr[i], indptr[i + 1]
+                row = zip(neighbours[start:end].tolist(), ratios[start:end])
+                self._neighbours[key] = [
+                    (keys[j], ratio) for j, ratio in row if keys[j] in self._ngrams
+                ]
+        for key in self._ngrams:
+            if key not in self._neighbours:
+                self._add_to_neighbours(key)
+        return True
+
+
+def _sort_key(item: Tuple[str, int]) -> Tuple[int, str]:
+    other, ratio = item
+    return -ratio, other
@@ -1,35 +1,43 @@
 import re
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from multiprocessing import Pool, cpu_count
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
-import numpy as np
 import pandas as pd
 import plotly.express as px
 from dash import dash_table
-from fuzzywuzzy import fuzz
 from plotly.graph_objects import Figure
 
 from database import Database, Transaction
-
-
-def compute_similarity(df):
-    return df.apply(lambda col: [fuzz.ratio(col.name, x) for x in col.index])
+from query import Query
+from similarity import SimilarityIndex, name_key
+from suggestions import CategorySuggester
 
 
 class Basic:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self.version = 0
+        self._update_key = None
         self.update()
 
     def update(self):
         with Database(self.db_path) as db:
+            update_key = db.generation()
+            if update_key == self._update_key:
+                return
+            self._update_key = update_key
+            self.version += 1
             self.category_list = db.get_all_categories()
-            query = f"SELECT * FROM {db.table_name}"
-            df = pd.read_sql_query(query, db.connection)
-        df["date"] = pd.to_datetime(df.date, format="%Y-%m-%d")
-        self.year_list = list(df.groupby(df.date.dt.year)["date"].max().index)
+            # Read the years from the date index, instead of the whole table.
+            result = db.cursor.execute(
+                f"SELECT DISTINCT substr(date, 1, 4) FROM {db.table_name} ORDER BY 1"
+            )
+            self.year_list = [int(year) for year, in result.fetchall()]
 
     def get_year_list(self) -> List[int]:
         return self.year_list
@@ -39,6 +47,14 @@ class Basic:
 
 
 class Plot:
+    """
+    Setters only record the parameters. The charts are computed by `render`,
+    once, when they are next requested.
+    """
+
+    # Attributes set by the user, saved with the session.
+    PARAMS = ("category_list", "interval", "start_date", "end_date", "extrapolate")
+
     def __init__(self, db_path: str):
         self.db_path = db_path
         self.category_list = None
@@ -46,28 +62,26 @@ class Plot:
         self.start_date = None
         self.end_date = None
         self.extrapolate = False
-        self.update()
+        self.version = 0
+        self._update_key = None
+        self._render_key = None
+        # Amounts per period and category, and line charts, by interval.
+        self._grouped = {}
+        self._fig_line = {}
 
     def set_extrapolate(self, extrapolate: bool):
-        if self.extrapolate != extrapolate:
-            self.extrapolate = extrapolate
-            self.update()
+        self.extrapolate = extrapolate
 
     def set_category_list(self, category_list: List[str]) -> None:
-        if self.category_list == category_list:
-            return
         self.category_list = category_list
-        self.update()
 
     def set_interval(self, interval: str) -> None:
         assert interval in ["MS", "YS"]
         self.interval = interval
-        self.fig_line = self.make_line()
 
     def set_date_range(self, start_date: str, end_date: str):
         self.start_date = start_date
         self.end_date = end_date
-        self.update()
 
     def set_year(self, year: str):
         if year is not None:
@@ -80,23 +94,47 @@ class Plot:
     def get_category_list(self) -> Optional[List[str]]:
         return self.category_list
 
+    def get_params(self) -> dict:
+        return {name: getattr(self, name) for name in self.PARAMS}
+
+    def set_params(self, params: dict) -> None:
+        for name in self.PARAMS:
+            if name in params:
+                setattr(self, name, params[name])
+
     def update(self) -> None:
+        self.render()
+
+    def render(self) -> None:
+        """
+        Compute the charts for the current parameters. Data is only read again
+        if it or the filters changed, and the line chart of each interval is
+        kept until then.
+        """
         with Database(self.db_path) as db:
-            if self.category_list is None:
-                query = f"SELECT * FROM {db.table_name} WHERE category IS NOT NULL"
-            else:
-                categories = ",".join([f"'{c}'" for c in self.category_list])
-                query = (
-                    f"SELECT * FROM {db.table_name} "
-                    f"WHERE category IN ({categories})"
-                )
-            if self.start_date is not None:
-                query += f" AND date >= '{self.start_date}'"
-            if self.end_date is not None:
-                query += f" AND date <= '{self.end_date}'"
-            self.df = pd.read_sql_query(query, db.connection)
-            self.df["date"] = pd.to_datetime(self.df.date, format="%Y-%m-%d")
+            update_key = (
+                db.generation(),
+                None if self.category_list is None else tuple(self.category_list),
+                self.start_date,
+                self.end_date,
+                # Extrapolation depends on the current date.
+                datetime.now().date() if self.extrapolate else None,
+            )
+            if update_key != self._update_key:
+                self._update_key = update_key
+                self.df = self.read_monthly_totals(db)
+                self._update_df()
+        render_key = (self._update_key, self.interval)
+        if render_key != self._render_key:
+            self._render_key = render_key
+            self.version += 1
+        if self.interval not in self._fig_line:
+            self._fig_line[self.interval] = self.make_line()
 
+    def _update_df(self) -> None:
+        """
+        Add the extrapolated months to the data read, and draw the pie chart.
+        """
         # Extrapolate the final year such that if an amount X is spent in N
         # days, we expect X * 365/N to be spent by the end of the year. The
         # remainder, X * (365/N - 1), is then split evenly across each
@@ -133,8 +171,66 @@ class Plot:
             # Concatenate the dataframes together and add to our df.
             self.df = pd.concat([self.df] + df_list)
 
-        self.fig_pie = px.pie(self.df, values="amount", names="category")
-        self.fig_line = self.make_line()
+        df_pie = self.df.groupby("category", as_index=False)["amount"].sum()
+        self.fig_pie = px.pie(df_pie, values="amount", names="category")
+        self._grouped = {}
+        self._fig_line = {}
+
+    def read_monthly_totals(self, db) -> pd.DataFrame:
+        """
+        Total amount per month and category, dated on the first of the month.
+        Months fully inside the date range are read from the monthly_totals
+        rollup. The first and last months of the range may be only partly
+        covered, so their transactions are summed directly.
+        """
+        rollup_query = Query("monthly_totals", "month, category, total")
+        edge_columns = "substr(date, 1, 7) AS month, category, SUM(amount) AS total"
+        edge_query_list = []
+        start_month = end_month = None
+        if self.start_date is not None:
+            start_month = self.start_date[:7]
+            rollup_query.where("month > ?", start_month)
+        if self.end_date is not None:
+            end_month = self.end_date[:7]
+            rollup_query.where("month < ?", end_month)
+        if start_month is not None and start_month == end_month:
+            edge_query_list.append(
+                Query(db.table_name, edge_columns).where_date_range(
+                    self.start_date, self.end_date
+                )
+            )
+        else:
+            if start_month is not None:
+                edge_query_list.append(
+                    Query(db.table_name, edge_columns)
+                    .where("date >= ?", self.start_date)
+                    .where("date < ?", _next_month(start_month))
+                )
+            if end_month is not None:
+                edge_query_list.append(
+                    Query(db.table_name, edge_columns)
+                    .where("date >= ?", f"{end_month}-01")
+                    .where("date <= ?", self.end_date)
+                )
+
+        df_list = []
+        for query in [rollup_query] + edge_query_list:
+            if self.category_list is None:
+                query.where_category("*")
+            else:
+                query.where_in("category", self.category_list)
+            if query is not rollup_query:
+                query.group_by("month, category")
+            sql, params = query.build()
+            df_list.append(pd.read_sql_query(sql, db.connection, params=params))
+
+        df = (
+            pd.concat(df_list)
+            .groupby(["month", "category"], as_index=False)["total"]
+            .sum()
+        )
+        df["date"] = pd.to_datetime(df.month, format="%Y-%m")
+        return df.rename(columns={"total": "amount"})[["date", "category", "amount"]]
 
     def make_line(self) -> Figure:
         assert self.interval in ["MS", "YS"]
@@ -143,21 +239,7 @@ class Plot:
         if len(self.df) == 0:
             return px.area(self.df, x="date", y=[])
 
-        # Group amounts by category, interpolate index by time interval, and
-        # within each interval, sum all the amounts of each category.
-        df = (
-            self.df.fillna("null")
-            .set_index("date")
-            .groupby([pd.Grouper(freq=self.interval), "category"])
-            .agg({"amount": "sum"})
-            .unstack()
-            .fillna(0)
-            .resample(self.interval)
-            .sum()
-        )
-
-        # Simplify MultiIndex columns (amount, <category>) to just category names.
-        df.columns = df.columns.get_level_values(1)
+        df = self.get_grouped(self.interval)
         fig = px.area(df, x=df.index, y=df.columns)
         if self.interval == "MS":
             fig.update_layout(
@@ -171,91 +253,373 @@ class Plot:
             AssertionError(f"interval={self.interval} not in ['M', 'Y']")
         return fig
 
+    def get_grouped(self, interval: str) -> pd.DataFrame:
+        """
+        Amounts per period and category, with a row per period and a column
+        per category. Yearly amounts are summed from the monthly ones.
+        """
+        if interval not in self._grouped:
+            if interval == "YS":
+                df = self.get_grouped("MS").resample("YS").sum()
+            else:
+                # Group amounts by category, interpolate index by month, and
+                # within each month, sum all the amounts of each category.
+                df = (
+                    self.df.fillna("null")
+                    .set_index("date")
+                    .groupby([pd.Grouper(freq="MS"), "category"])
+                    .agg({"amount": "sum"})
+                    .unstack()
+                    .fillna(0)
+                    .resample("MS")
+                    .sum()
+                )
+
+                # Simplify MultiIndex columns (amount, <category>) to just
+                # category names.
+                df.columns = df.columns.get_level_values(1)
+            self._grouped[interval] = df
+        return self._grouped[interval]
+
     def get_df(self, category: Optional[str] = None) -> pd.DataFrame:
         if category is not None and category != self.category:
             self.set_category(category)
+        self.render()
         return self.df
 
     def get_fig_pie(self, category: Optional[str] = None) -> Figure:
         if category is not None and category != self.category:
             self.set_category(category)
+        self.render()
         return self.fig_pie
 
     def get_fig_line(self, category: Optional[str] = None) -> Figure:
         if category is not None and category != self.category:
             self.set_category(category)
-        return self.fig_line
+        self.render()
+        return self._fig_line[self.interval]
+
+
+def _next_month(month: str) -> str:
+    """
+    First day of the month after `month`, given as "YYYY-MM".
+    """
+    year, month = int(month[:4]), int(month[5:7])
+    if month == 12:
+        return f"{year + 1}-01-01"
+    return f"{year}-{month + 1:02d}-01"
+
+
+# Name of the similarity cache files in the older format: the database hash.
+_OLD_CACHE_NAME = re.compile(r"[0-9a-f]+")
+
+
+def warm_similarity_cache(name_list: List[str], cache_path: Path) -> None:
+    """
+    Compute the similarities of names that are not in the cache yet, and save
+    them to the cache. This runs in a worker process, so that the app stays
+    responsive.
+    """
+    name_similarity = SimilarityIndex({name_key(name) for name in name_list})
+    name_similarity.load(cache_path)
+    name_similarity.compute_all()
+    name_similarity.save(cache_path)
+
+
+class NameSimilarity:
+    """
+    Similarity index of the uncategorized names of a database, and the model
+    suggesting their category. Both are costly to build and only depend on
+    the database, so they are shared by all sessions of a worker. Their
+    methods may be called from several threads.
+
+    The model is kept in sync with the categories in the database, which
+    other sessions and workers also write. It records the generation of the
+    database it reflects. Writes of the sessions of this worker update it in
+    place; after other writes, it is synced from the database.
+    """
+
+    def __init__(self, db_path: str, background: bool = True):
+        self.db_path = db_path
+        cache_dir = Path(self.db_path).parent.joinpath(".similarity_cache")
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_path = cache_dir.joinpath("neighbours.npz")
+        self.names_by_key = {}
+        self.index = None
+        self._lock = threading.Lock()
+        self.ready = threading.Event()
+        # Error that stopped the similarity index from being computed, if any.
+        self.error = None
+        self._requested = threading.Event()
+        self._background = background
+        self._suggester = CategorySuggester()
+        # Category and mean amount of each name the model learned.
+        self._learned: Dict[str, Tuple[str, float]] = {}
+        self._suggester_generation = None
+        self._suggester_lock = threading.Lock()
+        self.sync_suggester()
+        if background:
+            threading.Thread(target=self._worker, daemon=True).start()
+        self.request_update()
+
+    def request_update(self):
+        """
+        Have the similarity index updated with the names added since it was
+        computed. Runs in the background, unless `background` is False.
+        """
+        if self._background:
+            self._requested.set()
+        else:
+            self.compute()
+
+    def _worker(self):
+        try:
+            while True:
+                self._requested.wait()
+                self._requested.clear()
+                self.compute()
+        except Exception as e:
+            traceback.print_exc()
+            with self._lock:
+                self.error = str(e)
+                self.ready.set()
+
+    def compute(self):
+        """
+        Index the uncategorized names, to look up similar names. Similarities
+        are loaded from the cache, where it exists, and those of names missing
+        from it are computed in a worker process. The new index then replaces
+        the current one.
+
+        Until the first index is ready, `get_similar_names` returns None. After
+        that, names added since the index was computed are missing from it
+        until it is computed again.
+        """
+        with Database(self.db_path) as db:
+            all_names = list(db.get_uncategorized_names())
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            executor.submit(warm_similarity_cache, all_names, self.cache_path).result()
+
+        names_by_key = {}
+        for name in all_names:
+            names_by_key.setdefault(name_key(name), set()).add(name)
+        index = SimilarityIndex(names_by_key)
+        if index.load(self.cache_path):
+            print("Loaded name similarities from cache")
+
+        # Remove caches in the older format, named by the database hash. Files
+        # being saved by other processes have other names.
+        for path in self.cache_path.parent.iterdir():
+            if _OLD_CACHE_NAME.fullmatch(path.name) is not None:
+                path.unlink(missing_ok=True)
+
+        with self._lock:
+            self.names_by_key = names_by_key
+            self.index = index
+            self.ready.set()
+
+        # Catch up with names categorized or imported in the meantime.
+        with Database(self.db_path) as db:
+            self.update(db.get_uncategorized_names())
+
+    def update(self, names):
+        """
+        Remove names that were categorized from the similarity index, and have
+        new uncategorized names added to it in the background.
+        """
+        if self.index is None:
+            return
+        with self._lock:
+            names = set(names)
+            indexed_names = set().union(*self.names_by_key.values())
+            self._remove(indexed_names - names)
+        if len(names - indexed_names):
+            self.request_update()
+
+    def _remove(self, names):
+        """
+        Remove names from the similarity index. Call with the lock held.
+        """
+        for name in names:
+            key = name_key(name)
+            key_names = self.names_by_key.get(key, set())
+            key_names.discard(name)
+            if len(key_names) == 0:
+                self.names_by_key.pop(key, None)
+                self.index.remove(key)
+
+    def remove(self, names):
+        if self.index is None:
+            return
+        with self._lock:
+            self._remove(names)
+
+    def get_similar_names(self, name: str) -> Optional[List[str]]:
+        """
+        Names similar to `name`, most similar first, or None while the
+        similarity index is still being computed. Names that only differ from
+        `name` by digits or punctuation come first. Empty if the index could
+        not be computed; see `error`.
+        """
+        if not self.ready.is_set():
+            return None
+        if self.index is None:
+            return []
+        key = name_key(name)
+        with self._lock:
+            similar_names = sorted(self.names_by_key.get(key, set()) - {name})
+            for other_key, _ in self.index.neighbours(key):
+                similar_names.extend(sorted(self.names_by_key[other_key]))
+            return similar_names
+
+    def suggest(self, name: str, amount: float) -> List[Tuple[str, float]]:
+        """
+        Suggested categories for a name. Call `sync_suggester` first to take
+        changes from other workers into account.
+        """
+        with self._suggester_lock:
+            return self._suggester.suggest(name, amount)
+
+    def get_confident_categories(self, min_confidence: float) -> Dict[str, str]:
+        """
+        The suggested category of every uncategorized name whose suggestion
+        has a probability of at least `min_confidence`. Nothing is written, so
+        that this can run outside of the requests of a session, e.g. in a job.
+        """
+        self.sync_suggester()
+        with Database(self.db_path) as db:
+            names = db.get_uncategorized_names()
+            amounts = db.get_mean_amounts(list(names))
+        category_by_name = {}
+        for name in names:
+            suggestions = self.suggest(name, amounts.get(name, 0.0))
+            if len(suggestions) and suggestions[0][1] >= min_confidence:
+                category_by_name[name] = suggestions[0][0]
+        return category_by_name
+
+    def sync_suggester(self) -> None:
+        """
+        Update the model with the categories in the database, if they changed
+        since it was last updated. Only the names whose category or amount
+        changed are learned or forgotten.
+        """
+        with self._suggester_lock:
+            with Database(self.db_path) as db:
+                generation = db.generation()
+                if generation == self._suggester_generation:
+                    return
+                learned = {
+                    name: (category, amount)
+                    for name, category, amount in db.get_categorized_names()
+                }
+            for name, (category, amount) in self._learned.items():
+                if learned.get(name) != (category, amount):
+                    self._suggester.forget(name, amount, category)
+            for name, (category, amount) in learned.items():
+                if self._learned.get(name) != (category, amount):
+                    self._suggester.learn(name, amount, category)
+            self._learned = learned
+            self._suggester_generation = generation
+
+    def categories_written(
+        self,
+        category_by_name: Dict[str, Optional[str]],
+        amounts: Dict[str, float],
+        generation_before: int,
+        generation_after: int,
+    ) -> None:
+        """
+        Update the model with categories written by a session, as the database
+        went from `generation_before` to `generation_after`. If the model did
+        not reflect `generation_before`, it is synced on the next
+        `sync_suggester` instead.
+        """
+        with self._suggester_lock:
+            if generation_before != self._suggester_generation:
+                return
+            for name, category in category_by_name.items():
+                old = self._learned.pop(name, None)
+                if old is not None:
+                    self._suggester.forget(name, old[1], old[0])
+                # Ignored and unknown names have no category to learn.
+                if category not in (None, "__UNKNOWN__") and name in amounts:
+                    self._learned[name] = (category, amounts[name])
+                    self._suggester.learn(name, amounts[name], category)
+            self._suggester_generation = generation_after
 
 
 class Uncategorized:
-    def __init__(self, db_path: str):
+    """
+    Work queue of uncategorized names of one session, highest count first.
+    Actions update the queue, the database and the shared similarity index in
+    place, so that each step costs the same regardless of the number of names
+    left.
+
+    The queue is the uncategorized names of the database, less those in the
+    history, so the history is all the state saved with the session. Actions
+    take the name shown to the user: the database may have changed since,
+    e.g. by another session.
+    """
+
+    def __init__(self, db_path: str, name_similarity: NameSimilarity):
         self.db_path = db_path
-        self._current_name = None
+        self.name_similarity = name_similarity
         self._history = []
-        self.compute_name_similarity_matrix()
         self.reset()
 
     def update(self):
+        """
+        Reload the queue from the database, if it changed since the last
+        update.
+        """
         with Database(self.db_path) as db:
+            update_key = db.generation()
+            if update_key == self._update_key:
+                return
+            self._update_key = update_key
             self.uncategorized_names = db.get_uncategorized_names()
-            for name, _, _ in self._history:
+            self.name_similarity.update(self.uncategorized_names)
+            for name, _, _, _ in self._history:
                 # History contains skipped items that are still uncategorized
                 # in the database. Ignore these by removing them.
                 if name in self.uncategorized_names:
                     self.uncategorized_names.pop(name)
             self.category_list = db.get_all_categories()
 
+        # Names are sorted by increasing count. Process them from highest
+        # count to lowest. Names are removed from the queue lazily: those no
+        # longer in uncategorized_names are skipped.
+        self._queue = deque(reversed(self.uncategorized_names))
+
     def reset(self):
-        self._current_name = None
         self._history = []
+        self._update_key = None
         self.update()
 
-    def compute_name_similarity_matrix(self):
-        with Database(self.db_path) as db:
-            db_hash = db.hash()
-            all_names = db.cursor.execute(
-                f"SELECT name FROM {db.table_name} WHERE category=?",
-                ("__UNKNOWN__",),
-            ).fetchall()
-        name_mapping = {
-            re.sub(r"[\W\d]+", "", name[0].lower()): name[0] for name in all_names
-        }
-
-        # Load from cache if exists, else compute and save cache.
-        cache_dir = Path(self.db_path).parent.joinpath(".similarity_cache")
-        cache_dir.mkdir(parents=True, exist_ok=True)
-        cache_path = cache_dir.joinpath(f"{db_hash}")
-        if cache_path.exists():
-            ct = pd.read_csv(cache_path).set_index("key")
-            print("Loaded name similarities from cache")
-        else:
-            df = pd.DataFrame(
-                zip(name_mapping.keys(), name_mapping.values()),
-                columns=["key", "name"],
-            )
-            ct = pd.crosstab(df["key"], df["key"])
-            ct_split = np.array_split(ct, cpu_count())
-            with Pool(cpu_count()) as pool:
-                print("Computing name similarities ...")
-                ct = pd.concat(pool.map(compute_similarity, ct_split))
-                print("DONE")
-            ct.to_csv(cache_path)
+    def get_params(self) -> dict:
+        return {"history": [list(item) for item in self._history]}
 
-        self.name_similarity = ct
-        self.name_mapping = name_mapping
+    def set_params(self, params: dict) -> None:
+        if "history" in params:
+            self._history = [
+                (name, count, similar_names, category)
+                for name, count, similar_names, category in params["history"]
+            ]
+            self._update_key = None
+            self.update()
 
     def get_name_to_process(self) -> Tuple[str, int, Transaction, int, int]:
+        # Skip names removed from uncategorized_names since they were queued.
+        while len(self._queue) and self._queue[0] not in self.uncategorized_names:
+            self._queue.popleft()
+
         # Raise StopIteration when no more uncategorized_names left.
-        if len(self.uncategorized_names) == 0:
+        if len(self._queue) == 0:
             self.reset()
             raise StopIteration
 
-        # Iterate names in reverse order (highest count to lowest). This
-        # makes it easy to re-add items to the end of the dict, in case of
-        # undo.
-        name = list(self.uncategorized_names.keys())[-1]
+        name = self._queue[0]
         count = self.uncategorized_names[name]
-        self._current_name = name
 
         # Get one example of a matching transaction.
         with Database(self.db_path) as db:
@@ -270,87 +634,202 @@ class Uncategorized:
         n_total = n_done + len(self.uncategorized_names)
 
         # Identify similar names.
-        similar_names = self.get_similar_names(name)
+        similar_names = self.name_similarity.get_similar_names(name)
 
         return name, similar_names, count, tx_example, n_done, n_total
 
-    def get_similar_names(self, name: str):
-        key = re.sub(r"[\W\d]+", "", name.lower())
-        df = self.name_similarity[key].sort_values(ascending=False)
-        similar_keys = list(df[df > 75].index)
-        similar_names = [self.name_mapping[key] for key in similar_keys]
-        return similar_names[1:]  # Skip self match
+    def get_suggestions(self, name: str, n: int = 3) -> List[Tuple[str, float]]:
+        """
+        The `n` most probable categories for a name, with their probability.
+        """
+        self.name_similarity.sync_suggester()
+        with Database(self.db_path) as db:
+            amount = db.get_mean_amounts([name]).get(name, 0.0)
+        return self.name_similarity.suggest(name, amount)[:n]
 
-    def set_category(self, category: str, similar_names: Optional[List[str]] = None):
+    def _pop(self, name: str) -> Optional[int]:
+        """
+        Remove a name from the queue and return its count. Returns None if the
+        name is no longer uncategorized, e.g. because another session
+        categorized it.
+        """
+        self.update()
+        if len(self._queue) and self._queue[0] == name:
+            self._queue.popleft()
+        return self.uncategorized_names.pop(name, None)
+
+    def _set_categories(self, category_by_name: Dict[str, Optional[str]]):
+        """
+        Write categories to the database. The caller applies the same change to
+        the queue, so the queue is only reloaded by the next update if another
+        session changed the database since the last one. The suggestion model
+        learns the new categories.
+        """
+        with Database(self.db_path) as db:
+            db.cursor.execute("BEGIN IMMEDIATE")
+            generation_before = db.generation()
+            db.set_categories(category_by_name, commit=False)
+            generation = db.generation()
+            amounts = db.get_mean_amounts(list(category_by_name))
+            db.connection.commit()
+        if generation_before == self._update_key:
+            self._update_key = generation
+        self.name_similarity.categories_written(
+            category_by_name, amounts, generation_before, generation
+        )
+
+    def set_category(
+        self,
+        name: str,
+        category: Optional[str],
+        similar_names: Optional[List[str]] = None,
+    ):
+        count = self._pop(name)
+        if count is None:
+            return
         if similar_names is None:
             similar_names = []
-        name = self._current_name
-        count = self.uncategorized_names.pop(name)
-        with Database(self.db_path) as db:
-            db.set_name_category(name, category)
-            for s_name in similar_names:
-                db.set_name_category(s_name, category)
-        self._history.append((name, count, similar_names))
+        # Remember the counts of the similar names, to queue them again on
+        # undo. Those not in the queue, because they were skipped, get None.
+        similar_names = {
+            s_name: self.uncategorized_names.pop(s_name, None)
+            for s_name in similar_names
+        }
+        self._set_categories(dict.fromkeys([name, *similar_names], category))
+        if category is not None and category not in self.category_list:
+            self.category_list.append(category)
+        self.name_similarity.remove([name, *similar_names])
+        self._history.append((name, count, similar_names, category))
+
+    def auto_categorize(self, min_confidence: float) -> int:
+        """
+        Set the suggested category of every remaining name whose suggestion
+        has a probability of at least `min_confidence`. Each name is added to
+        the history, so it can be undone. Returns the number of names
+        categorized.
+        """
+        return self.apply_categories(
+            self.name_similarity.get_confident_categories(min_confidence)
+        )
+
+    def apply_categories(self, category_by_name: Dict[str, str]) -> int:
+        """
+        Set the category of the names still in the queue, e.g. as suggested
+        by `NameSimilarity.get_confident_categories`. Each name is added to
+        the history, so it can be undone. Returns the number of names
+        categorized.
+        """
         self.update()
+        category_by_name = {
+            name: category
+            for name, category in category_by_name.items()
+            if name in self.uncategorized_names
+        }
+        self._set_categories(category_by_name)
+        for name in category_by_name:
+            count = self.uncategorized_names.pop(name)
+            self._history.append((name, count, {}, None))
+        self.name_similarity.remove(category_by_name)
+        return len(category_by_name)
 
-    def skip(self):
+    def skip(self, name: str):
         """
         Move from uncategorized_names to history without updating DB.
         """
-        name = self._current_name
-        count = self.uncategorized_names.pop(name)
-        self._history.append((name, count, []))
+        count = self._pop(name)
+        if count is not None:
+            self._history.append((name, count, {}, None))
 
     def undo(self):
         if len(self._history) == 0:
             # Nothing to undo.
             return
 
-        name, count, similar_names = self._history.pop()  # Remove
-        self._current_name = (name, count)  # Pointer
-        self.uncategorized_names[name] = count  # Restore
+        name, count, similar_names, _ = self._history.pop()
 
         # Roll back DB changes.
-        with Database(self.db_path) as db:
-            db.set_name_category(name, "__UNKNOWN__")
-            for s_name in similar_names:
-                db.set_name_category(s_name, "__UNKNOWN__")
+        self._set_categories(dict.fromkeys([name, *similar_names], "__UNKNOWN__"))
+        self.name_similarity.request_update()
+
+        # Queue the name next, followed by the similar names that were queued.
+        for s_name, s_count in reversed(similar_names.items()):
+            if s_count is not None:
+                self.uncategorized_names[s_name] = s_count
+                self._queue.appendleft(s_name)
+        self.uncategorized_names[name] = count
+        self._queue.appendleft(name)
 
-        self.update()
+
+# Columns the paged table can be sorted by.
+SORT_COLUMNS = ["date", "name", "amount", "category"]
 
 
 class Table:
+    """
+    Transactions matching the filters, as a DataTable. With a `page_size`,
+    the table is paged and sorted server-side: only the visible page is
+    queried and sent to the browser.
+    """
+
+    # Attributes set by the user, saved with the session.
+    PARAMS = (
+        "category",
+        "start_date",
+        "end_date",
+        "regex_query",
+        "page_current",
+        "sort_by",
+    )
+
     def __init__(
         self,
         db_path: str,
         table_id: str = "table",
         group_by_name: bool = False,
         row_selectable: str = "multi",
+        page_size: Optional[int] = None,
     ):
+        assert page_size is None or not group_by_name
         self.db_path = db_path
         self.table_id = table_id
         self.group_by_name = group_by_name
         self.row_selectable = row_selectable
+        self.page_size = page_size
+        self.page_current = 0
+        self.page_count = 1
+        self.sort_by = []
         self.start_date = None
         self.end_date = None
         self.records = None
+        # Records by row id: the rowid of the transaction, or the name when
+        # grouping by name.
+        self._records_by_id = {}
         self.table = None
+        self.version = 0
+        self._update_key = None
+        # Sort key of the last row of each page read, for keyset pagination.
+        # Valid for one data generation, set of filters and sort order.
+        self._page_keys = {}
+        self._page_keys_key = None
         self.reset()
 
     def reset(self):
         self.category = "*"
         self.regex_query = ""
+        self.page_current = 0
         self.update()
 
     def set_category(self, category: str) -> None:
         if category == self.category:
             return
         self.category = category
+        self.page_current = 0
         self.update()
 
     def set_date_range(self, start_date: str, end_date: str):
         self.start_date = start_date
         self.end_date = end_date
+        self.page_current = 0
         self.update()
 
     def set_year(self, year: str):
@@ -361,54 +840,86 @@ class Table:
             start_date = end_date = None
         self.set_date_range(start_date, end_date)
 
+    def set_page(self, page_current: Optional[int], sort_by: Optional[list]):
+        """
+        Show a page of the paged table, sorted by a column as given by the
+        DataTable `sort_by` property. Back to the first page if the sort
+        order changed.
+        """
+        sort_by = sort_by or []
+        if sort_by != self.sort_by:
+            self.sort_by = sort_by
+            page_current = 0
+        self.page_current = page_current or 0
+        self.update()
+
+    def get_sort(self) -> Tuple[str, str]:
+        """
+        Column and direction of the sort, newest first by default.
+        """
+        for sort in self.sort_by:
+            if sort["column_id"] in SORT_COLUMNS:
+                direction = "ASC" if sort["direction"] == "asc" else "DESC"
+                return sort["column_id"], direction
+        return "date", "DESC"
+
     def update(self):
-        # Query
-        if self.category == "*":
-            category_query = "category IS NOT NULL"
-        elif self.category is None:
-            category_query = "category IS NULL"
-        else:
-            category_query = f'category="{self.category}"'
-        if self.start_date is not None:
-            category_query += f" AND date >= '{self.start_date}'"
-        if self.end_date is not None:
-            category_query += f" AND date <= '{self.end_date}'"
+        """
+        Rebuild the table, unless neither the data, the filters nor the page
+        changed since the last update.
+        """
         with Database(self.db_path) as db:
+            update_key = (
+                db.generation(),
+                self.category,
+                self.start_date,
+                self.end_date,
+                self.regex_query,
+                self.get_sort(),
+            )
+            if (update_key, self.page_current) == self._update_key:
+                return
+            self._update_key = (update_key, self.page_current)
+            self.version += 1
+            if update_key != self._page_keys_key:
+                self._page_keys = {}
+                self._page_keys_key = update_key
             category_list = db.get_all_categories()
             if self.group_by_name:
-                db.connection.create_function(
-                    "REGEXP",
-                    2,
-                    lambda x, y: 1 if re.search(x, y, re.IGNORECASE) else 0,
+                query = (
+                    Query(
+                        db.table_name,
+                        "name AS id, name, COUNT(*), SUM(amount), category",
+                    )
+                    .group_by("name")
+                    .order_by("COUNT(*) DESC")
                 )
-                df = pd.read_sql_query(
-                    "SELECT name, COUNT(*), SUM(amount), "
-                    f"category FROM {db.table_name} "
-                    f"WHERE {category_query} "
-                    f"AND name REGEXP '{self.regex_query}' "
-                    "GROUP BY name ORDER BY COUNT(*) DESC",
-                    db.connection,
+            elif self.page_size is not None:
+                query = Query(
+                    db.table_name, "rowid AS id, date, name, amount, category"
                 )
-                df["SUM(amount)"] = df["SUM(amount)"].map(lambda x: round(x, 2))
             else:
-                db.connection.create_function(
-                    "REGEXP",
-                    2,
-                    lambda x, y: 1 if re.search(x, y, re.IGNORECASE) else 0,
-                )
-                df = pd.read_sql_query(
-                    f"SELECT * FROM {db.table_name} WHERE {category_query} "
-                    f"AND name REGEXP '{self.regex_query}' "
-                    "ORDER BY date DESC",
-                    db.connection,
-                )
+                query = Query(db.table_name, "rowid AS id, *").order_by("date DESC")
+            query.where_category(self.category)
+            query.where_date_range(self.start_date, self.end_date)
+            query.where_name_matches(self.regex_query)
+            if self.page_size is not None:
+                column_list, self.records = self.read_page(db, query)
+            else:
+                sql, params = query.build()
+                df = pd.read_sql_query(sql, db.connection, params=params)
+                if self.group_by_name:
+                    df["SUM(amount)"] = df["SUM(amount)"].map(lambda x: round(x, 2))
+                column_list = list(df.columns)
+                self.records = df.to_dict("records")
+            self._records_by_id = {record["id"]: record for record in self.records}
 
         # Create a table where the 'category' column is editable and has a
         # dropdown menu to select the category.
         category_options = sorted(category_list)
         dropdown_options = [{"label": i, "value": i} for i in category_options]
         columns = []
-        for c in df.columns:
+        for c in column_list:
             if c == "category":
                 columns.append(
                     {
@@ -418,14 +929,25 @@ class Table:
                         "presentation": "dropdown",
                     }
                 )
-            else:
+            elif c != "id":
                 columns.append({"name": c, "id": c})
+        if self.page_size is not None:
+            paging = dict(
+                page_action="custom",
+                page_current=self.page_current,
+                page_size=self.page_size,
+                page_count=self.page_count,
+                sort_action="custom",
+                sort_mode="single",
+                sort_by=self.sort_by,
+            )
+        else:
+            paging = dict(sort_action="native")
         table = dash_table.DataTable(
             id=self.table_id,
-            data=df.to_dict("records"),
+            data=self.records,
             columns=columns,
             row_selectable=self.row_selectable,
-            sort_action="native",
             dropdown={"category": {"options": dropdown_options}},
             # style_cell_conditional=[
             # {
@@ -442,24 +964,78 @@ class Table:
                     "rule": "display: block !important",
                 },
             ],  # github.com/plotly/dash-table/issues/221
+            **paging,
         )
-        self.records = df.to_dict("records")
         self.table = table
 
+    def read_page(self, db, query: Query) -> Tuple[List[str], List[dict]]:
+        """
+        Read the current page. If the previous page was read, the page starts
+        after its last row (keyset pagination), which is a search on the sort
+        index rather than a scan of the skipped rows. Otherwise, rows are
+        skipped with OFFSET.
+        """
+        sql, params = query.build_count()
+        n_rows = db.cursor.execute(sql, params).fetchone()[0]
+        self.page_count = max(1, -(-n_rows // self.page_size))
+        self.page_current = min(self.page_current, self.page_count - 1)
+
+        column, direction = self.get_sort()
+        query.order_by(f"{column} {direction}, rowid {direction}")
+        previous_key = self._page_keys.get(self.page_current - 1)
+        if self.page_current == 0:
+            query.limit(self.page_size)
+        elif previous_key is not None and previous_key[0] is not None:
+            operator = "<" if direction == "DESC" else ">"
+            query.where(f"({column}, rowid) {operator} (?, ?)", *previous_key)
+            query.limit(self.page_size)
+        else:
+            query.limit(self.page_size, self.page_current * self.page_size)
+        sql, params = query.build()
+        result = db.cursor.execute(sql, params)
+        column_list = [description[0] for description in result.description]
+        records = [dict(zip(column_list, row)) for row in result.fetchall()]
+        if len(records):
+            self._page_keys[self.page_current] = (
+                records[-1][column],
+                records[-1]["id"],
+            )
+        return column_list, records
+
     def get_table(self):
         return self.table
 
+    def get_params(self) -> dict:
+        return {name: getattr(self, name) for name in self.PARAMS}
+
+    def set_params(self, params: dict) -> None:
+        for name in self.PARAMS:
+            if name in params:
+                setattr(self, name, params[name])
+        self.update()
+
     def set_regex_query(self, query: str):
         self.regex_query = query
+        self.page_current = 0
         self.update()
 
-    def diff(self, data):
+    def diff(
+        self, data: List[dict], data_previous: Optional[List[dict]] = None
+    ) -> List[dict]:
         """
-        Compares the entries dash table to those in this table. Returns the
-        first entry for which the category differs.
+        Rows of the dash table whose category was edited, looked up by row id.
+        Only the rows that differ from `data_previous` are checked; there can
+        be several of them after a paste. The edits are applied to the records
+        of this table.
         """
-        assert self.records is not None
-        assert len(data) == len(self.records)
-        for new, old in zip(data, self.records):
-            if new["category"] != old["category"]:
-                return new
+        if data_previous is None or len(data_previous) != len(data):
+            candidates = data
+        else:
+            candidates = [new for new, old in zip(data, data_previous) if new != old]
+        changed = []
+        for new in candidates:
+            old = self._records_by_id.get(new.get("id"))
+            if old is not None and new["category"] != old["category"]:
+                old["category"] = new["category"]
+                changed.append(new)
+        return changed
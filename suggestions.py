@@ -0,0 +1,114 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from similarity import name_key
+
+# Additive smoothing of the feature counts.
+ALPHA = 1.0
+
+# Size of the character n-grams taken from the name key.
+NGRAM_SIZE = 3
+
+_WORDS = re.compile(r"[a-z]+")
+
+
+def features(name: str, amount: float) -> List[str]:
+    """
+    Words of the name, character n-grams of its key and the sign and order of
+    magnitude of the amount.
+    """
+    feature_list = [f"w:{word}" for word in _WORDS.findall(name.lower())]
+    key = name_key(name)
+    feature_list.extend(
+        f"g:{key[i : i + NGRAM_SIZE]}" for i in range(len(key) - NGRAM_SIZE + 1)
+    )
+    sign = "-" if amount < 0 else "+"
+    feature_list.append(f"a:{sign}{int(math.log2(1 + abs(amount)))}")
+    return feature_list
+
+
+class CategorySuggester:
+    """
+    Multinomial Naive Bayes model predicting the category of a name. Each
+    categorized name counts as one example, regardless of how many
+    transactions it has, so that frequent names do not drown out the others.
+
+    The model is updated incrementally with `learn` and `forget`.
+    """
+
+    def __init__(self, alpha: float = ALPHA):
+        self.alpha = alpha
+        self._class_counts: Counter = Counter()
+        # Number of features of each class.
+        self._class_totals: Counter = Counter()
+        # Feature -> category -> count.
+        self._feature_counts: Dict[str, Counter] = {}
+
+    @classmethod
+    def from_database(cls, db) -> "CategorySuggester":
+        suggester = cls()
+        for name, category, amount in db.get_categorized_names():
+            suggester.learn(name, amount, category)
+        return suggester
+
+    def __len__(self) -> int:
+        return sum(self._class_counts.values())
+
+    def learn(self, name: str, amount: float, category: str) -> None:
+        self._update(name, amount, category, 1)
+
+    def forget(self, name: str, amount: float, category: str) -> None:
+        self._update(name, amount, category, -1)
+
+    def _update(self, name: str, amount: float, category: str, delta: int) -> None:
+        feature_list = features(name, amount)
+        self._class_counts[category] += delta
+        self._class_totals[category] += delta * len(feature_list)
+        if self._class_counts[category] <= 0:
+            del self._class_counts[category]
+            del self._class_totals[category]
+        for feature in feature_list:
+            counts = self._feature_counts.setdefault(feature, Counter())
+            counts[category] += delta
+            if counts[category] <= 0:
+                del counts[category]
+                if len(counts) == 0:
+                    del self._feature_counts[feature]
+
+    def suggest(self, name: str, amount: float) -> List[Tuple[str, float]]:
+        """
+        Categories and their probability, most probable first.
+
+        Naive Bayes tends to be overconfident, so probabilities are best used
+        to rank categories, with a high threshold for applying them.
+        """
+        n_examples = len(self)
+        if n_examples == 0:
+            return []
+
+        # Features unseen in a class contribute log(alpha / denominator). Start
+        # from that for all features, and correct for the features seen.
+        feature_list = features(name, amount)
+        n_features = len(self._feature_counts)
+        log_alpha = math.log(self.alpha)
+        scores = {}
+        for category, count in self._class_counts.items():
+            denominator = self._class_totals[category] + self.alpha * n_features
+            scores[category] = math.log(count / n_examples) + len(feature_list) * (
+                log_alpha - math.log(denominator)
+            )
+        for feature in feature_list:
+            for category, count in self._feature_counts.get(feature, {}).items():
+                scores[category] += math.log(count + self.alpha) - log_alpha
+
+        max_score = max(scores.values())
+        weights = {
+            category: math.exp(score - max_score) for category, score in scores.items()
+        }
+        weight_sum = sum(weights.values())
+        return sorted(
+            [(category, weight / weight_sum) for category, weight in weights.items()],
+            key=lambda item: -item[1],
+        )
@@ -0,0 +1,95 @@
+"""
+Check that the schema of an old database file is migrated once when several
+processes open it at the same time, like the workers of the app, and that
+migrations repair the data left by older versions.
+
+Run with `python -m pytest`.
+"""
+
+import multiprocessing
+import sqlite3
+
+import database
+from database import MIGRATIONS, Database, Transaction
+
+N_PROCESSES = 4
+
+
+def open_database(path, barrier):
+    barrier.wait()
+    with Database(path) as db:
+        db.get_uncategorized_names()
+
+
+def test_concurrent_migration(tmp_path):
+    path = str(tmp_path.joinpath("db.sql"))
+    # Schema of the app before migrations were added.
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE bank_records("
+        "date TEXT,"
+        "name TEXT,"
+        "amount FLOAT,"
+        "category TEXT,"
+        "UNIQUE(date, name, amount)"
+        ")"
+    )
+    connection.executemany(
+        "INSERT INTO bank_records VALUES (?, ?, ?, ?)",
+        [
+            (f"2020-01-{i % 28 + 1:02d}", f"SHOP {i % 7}", i, "__UNKNOWN__")
+            for i in range(100)
+        ],
+    )
+    connection.commit()
+    connection.close()
+
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(N_PROCESSES)
+    process_list = [
+        context.Process(target=open_database, args=(path, barrier))
+        for _ in range(N_PROCESSES)
+    ]
+    for process in process_list:
+        process.start()
+    for process in process_list:
+        process.join()
+    assert [process.exitcode for process in process_list] == [0] * N_PROCESSES
+
+    connection = sqlite3.connect(path)
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    names = connection.execute("SELECT SUM(count) FROM names").fetchone()[0]
+    connection.close()
+    assert version == len(MIGRATIONS)
+    assert names == 100
+
+
+def test_names_category(tmp_path):
+    path = str(tmp_path.joinpath("db.sql"))
+    with Database(path) as db:
+        db.add_transactions(
+            [
+                Transaction("2020-01-01", "SHOP", -1.0),
+                Transaction("2020-01-02", "CAFE", -2.0),
+                Transaction("2020-01-03", "CAFE", -3.0, "food"),
+            ],
+            warn=False,
+        )
+        # A name without a category takes the one of a categorized transaction.
+        db.add_transactions([Transaction("2020-01-04", "SHOP", -4.0, "rent")])
+        assert db.get_uncategorized_names() == {}
+    database._get_pool(path).close()
+
+    # Names left without a category by the triggers of an older version.
+    connection = sqlite3.connect(path)
+    connection.execute("UPDATE names SET category = '__UNKNOWN__'")
+    connection.execute(f"PRAGMA user_version={len(MIGRATIONS) - 1}")
+    connection.commit()
+    connection.close()
+    # The pool of the file already checked its schema.
+    db = database._Database(path)
+    assert sorted(db.get_categorized_names()) == [
+        ("CAFE", "food", -2.5),
+        ("SHOP", "rent", -2.5),
+    ]
+    db.connection.close()
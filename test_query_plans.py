@@ -0,0 +1,157 @@
+"""
+Check with EXPLAIN QUERY PLAN that the queries of the dashboard are answered
+from indexes, rather than by scanning bank_records.
+
+Run with `python -m pytest`.
+"""
+
+import random
+from contextlib import contextmanager
+
+import pytest
+
+import database
+from database import Database, Transaction
+from state import Plot, Table
+
+CATEGORIES = ["food", "rent", "travel", "__UNKNOWN__", None]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path.joinpath("db.sql"))
+    rng = random.Random(0)
+    transaction_list = [
+        Transaction(
+            date=f"20{rng.randint(18, 23)}-{rng.randint(1, 12):02d}"
+            f"-{rng.randint(1, 28):02d}",
+            name=f"SHOP {i % 300}",
+            amount=round(rng.uniform(-500, 500), 2),
+            category=CATEGORIES[i % 300 % len(CATEGORIES)],
+        )
+        for i in range(5000)
+    ]
+    with Database(path) as db:
+        db.add_transactions(transaction_list, warn=False)
+    yield path
+    database._get_pool(path).close()
+
+
+@contextmanager
+def trace_statements(db_path):
+    """
+    Collect the statements run on the pooled connections of a database, with
+    their parameters bound.
+    """
+    statement_list = []
+    pool = database._get_pool(db_path)
+    db_list = [pool.acquire() for _ in range(4)]
+    for db in db_list:
+        db.connection.set_trace_callback(statement_list.append)
+        pool.release(db)
+    try:
+        yield statement_list
+    finally:
+        for db in db_list:
+            db.connection.set_trace_callback(None)
+
+
+def query_plans(db_path, statement_list, table):
+    """
+    Plans of the SELECT and UPDATE statements that read `table`.
+    """
+    plan_list = []
+    with Database(db_path) as db:
+        for sql in statement_list:
+            if sql.split()[0].upper() not in ("SELECT", "UPDATE"):
+                continue
+            plan = db.query_plan(sql)
+            if any(f" {table} " in f"{step} " for step in plan):
+                plan_list.append((sql, plan))
+    assert len(plan_list), f"No query on {table}"
+    return plan_list
+
+
+def assert_uses_index(plan_list, table):
+    for sql, plan in plan_list:
+        for step in plan:
+            if step.startswith(f"SCAN {table}") and "INDEX" not in step:
+                raise AssertionError(f"Full scan of {table}: {sql}\n{plan}")
+
+
+def test_plot(db_path):
+    plot = Plot(db_path)
+    plot.set_date_range("2019-03-15", "2021-06-10")
+    plot.set_category_list(["food", "rent"])
+    with trace_statements(db_path) as statement_list:
+        plot.render()
+
+    rollup_plans = query_plans(db_path, statement_list, "monthly_totals")
+    for sql, plan in rollup_plans:
+        assert plan[0].startswith("SEARCH monthly_totals USING"), plan
+    # Only the partly covered first and last months are read from
+    # bank_records, with the index on category and date.
+    edge_plans = query_plans(db_path, statement_list, "bank_records")
+    assert len(edge_plans) == 2
+    for sql, plan in edge_plans:
+        assert plan[0].startswith(
+            "SEARCH bank_records USING INDEX bank_records_category_date"
+        ), plan
+
+
+@pytest.mark.parametrize(
+    "category, year, sort_by",
+    [
+        ("*", None, []),
+        ("food", None, []),
+        ("*", "2020", []),
+        ("rent", "2021", []),
+        ("*", None, [{"column_id": "name", "direction": "asc"}]),
+    ],
+)
+def test_table(db_path, category, year, sort_by):
+    table = Table(db_path, page_size=50)
+    with trace_statements(db_path) as statement_list:
+        table.set_category(category)
+        table.set_year(year)
+        table.set_page(0, sort_by)
+        table.set_page(1, sort_by)
+
+    plan_list = query_plans(db_path, statement_list, "bank_records")
+    assert_uses_index(plan_list, "bank_records")
+    if sort_by == []:
+        # Pages are read in date order from an index, without sorting.
+        for sql, plan in plan_list:
+            assert not any("TEMP B-TREE FOR ORDER BY" in step for step in plan), plan
+
+
+def test_names(db_path):
+    with trace_statements(db_path) as statement_list:
+        with Database(db_path) as db:
+            db.get_uncategorized_names()
+            db.get_all_categories()
+            db.get_mean_amounts(["SHOP 1", "SHOP 2"])
+
+    plan_list = query_plans(db_path, statement_list, "names")
+    assert_uses_index(plan_list, "names")
+    uncategorized_plan = plan_list[0][1]
+    assert uncategorized_plan[0].startswith(
+        "SEARCH names USING INDEX names_category"
+    ), uncategorized_plan
+
+
+def test_set_categories(db_path):
+    with trace_statements(db_path) as statement_list:
+        with Database(db_path) as db:
+            db.set_categories({"SHOP 1": "food", "SHOP 2": "rent"})
+
+    plan_list = [
+        (sql, plan)
+        for sql, plan in query_plans(db_path, statement_list, "bank_records")
+        if sql.startswith("UPDATE bank_records")
+    ]
+    assert len({sql for sql, _ in plan_list}) == 2
+    for sql, plan in plan_list:
+        assert plan[0].startswith(
+            "SEARCH bank_records USING INDEX bank_records_name"
+        ), plan